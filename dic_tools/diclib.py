@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
+import hashlib
+import os
+import pickle
 import re
 import sys
+import tempfile
 
 from toolpath import toolpath
 
@@ -202,7 +205,7 @@ def to_seion(s):
     return s.translate(TO_SEION)
 
 
-def output(dict, file=sys.stdout, single=False):
+def output(dict, file=None, single=False):
     for yomi, words in sorted(dict.items()):
         if not single:
             print(f'{yomi} /{"/".join(words)}/', file=file)
@@ -226,34 +229,44 @@ def lookup(dict, word):
     return d
 
 
+# 常用漢字表をいちどだけよみこんで、各行をカンマでわけたリストをかえします。
+def _zyouyou_rows():
+    global _zyouyou_cache
+    if _zyouyou_cache is None:
+        with open(toolpath('zyouyou-kanji.csv'), 'r') as f:
+            _zyouyou_cache = tuple(tuple(row.strip().split(',')) for row in f)
+    return _zyouyou_cache
+
+
+_zyouyou_cache = None
+
+
 # 常用漢字表から辞書をつくります。
 def zyouyou(grade=10, exclude_special=False):
     dict = {}
-    with open(toolpath('zyouyou-kanji.csv'), 'r') as f:
-        for row in f:
-            row = row.strip().split(',')
-            kanji = row[0]
-            for yomi in row[1:]:
-                g = int(yomi[-1])
-                if grade < g:
-                    continue
-                g = yomi[-2:]
-                k = kanji
-                yomi = yomi[:-2]
-                if yomi[0] == '（' and exclude_special:
-                    continue
-                yomi = yomi.strip('（）')
-                yomi = to_hiragana(yomi)
-                pos = yomi.find('―')
-                if 0 <= pos:
-                    k += yomi[pos + 1:]
-                    yomi = yomi[:pos + 1]
-                k += g
-                if yomi not in dict:
-                    dict[yomi] = []
-                    dict[yomi].append(k)
-                elif k not in dict[yomi]:
-                    dict[yomi].append(k)
+    for row in _zyouyou_rows():
+        kanji = row[0]
+        for yomi in row[1:]:
+            g = int(yomi[-1])
+            if grade < g:
+                continue
+            g = yomi[-2:]
+            k = kanji
+            yomi = yomi[:-2]
+            if yomi[0] == '（' and exclude_special:
+                continue
+            yomi = yomi.strip('（）')
+            yomi = to_hiragana(yomi)
+            pos = yomi.find('―')
+            if 0 <= pos:
+                k += yomi[pos + 1:]
+                yomi = yomi[:pos + 1]
+            k += g
+            if yomi not in dict:
+                dict[yomi] = []
+                dict[yomi].append(k)
+            elif k not in dict[yomi]:
+                dict[yomi].append(k)
     for yomi, kanji in dict.items():
         cand = []
         for i in range(1, 10):
@@ -268,16 +281,14 @@ def zyouyou(grade=10, exclude_special=False):
 # 常用漢字表から漢字の学習年度辞書をつくります。
 def zyouyou_grades():
     grades = {}
-    with open(toolpath('zyouyou-kanji.csv'), 'r') as f:
-        for row in f:
-            grade = 10
-            row = row.strip().split(',')
-            kanji = row[0]
-            for yomi in row[1:]:
-                g = int(yomi[-1])
-                if g < grade:
-                    grade = g
-            grades[kanji] = grade
+    for row in _zyouyou_rows():
+        grade = 10
+        kanji = row[0]
+        for yomi in row[1:]:
+            g = int(yomi[-1])
+            if g < grade:
+                grade = g
+        grades[kanji] = grade
     return grades
 
 
@@ -289,9 +300,61 @@ def _get_encoding(path):
     return 'utf-8'
 
 
+# 解析ずみの辞書のキャッシュをおくディレクトリーです。
+# 環境変数DICTOOLS_CACHEで変更できます。空にするとキャッシュをつかいません。
+CACHE_DIR = os.environ.get('DICTOOLS_CACHE',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                        'ibus-hiragana', 'dic_tools'))
+
+# 解析の結果がかわるように_loadなどをなおしたときは、この値をふやしてください。
+# 解析関数のモジュールとdiclibのソースのハッシュもキーにふくめるので、
+# ソースをなおせばキャッシュはつかわれなくなります。
+PARSER_VERSION = 1
+
+_source_hashes = {}
+
+
+def _source_hash(module):
+    if module not in _source_hashes:
+        with open(sys.modules[module].__file__, 'rb') as f:
+            _source_hashes[module] = hashlib.sha256(f.read()).hexdigest()
+    return _source_hashes[module]
+
+
+# pathをparseで解析した結果をかえします。
+# 結果は、ファイルの内容のハッシュと解析関数の名前と版をキーにしてキャッシュしておき、
+# おなじ内容のファイルはつぎから解析しなおしません。
+def cached_parse(parse, path, version=PARSER_VERSION):
+    if not CACHE_DIR:
+        return parse(path)
+    h = hashlib.sha256(f'{parse.__module__}.{parse.__qualname__}:{version}:'
+                       f'{_source_hash(parse.__module__)}:{_source_hash(__name__)}:'.encode())
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    cache_path = os.path.join(CACHE_DIR, h.hexdigest() + '.pickle')
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    result = parse(path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=CACHE_DIR, delete=False) as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cache_path)
+    except OSError:
+        pass
+    return result
+
+
 # SKK辞書をよみこみます。用言は、よみの末尾に'―'をつけた形に変換します。
 # ※ annotationはとりのぞきます。
 def load(path):
+    return cached_parse(_load, path)
+
+
+def _load(path):
     encoding = _get_encoding(path)
     dict = {}
     with open(path, encoding=encoding) as f:
@@ -389,12 +452,17 @@ def copy_header(path):
             print(row)
 
 
+def _word_set(words):
+    return words if isinstance(words, dict) else set(words)
+
+
 # 2つの辞書の共通部分をとりだした辞書をかえします。
 def intersection(a, b):
     d = {}
     for yomi in set(a) & set(b):
         assert yomi in a and yomi in b
-        words = [x for x in a[yomi] if x in b[yomi]]
+        s = _word_set(b[yomi])
+        words = [x for x in a[yomi] if x in s]
         if words:
             d[yomi] = words
     return d
@@ -405,11 +473,12 @@ def union(a, b):
     d = {}
     for yomi in set(a) | set(b):
         if yomi not in a:
-            d[yomi] = b[yomi][:]
+            d[yomi] = list(b[yomi])
         elif yomi not in b:
-            d[yomi] = a[yomi][:]
+            d[yomi] = list(a[yomi])
         else:
-            d[yomi] = a[yomi] + [x for x in b[yomi] if x not in a[yomi]]
+            s = _word_set(a[yomi])
+            d[yomi] = list(a[yomi]) + [x for x in b[yomi] if x not in s]
     return d
 
 
@@ -418,11 +487,12 @@ def difference(a, b):
     d = {}
     for yomi in a:
         if yomi in b:
-            words = [x for x in a[yomi] if x not in b[yomi]]
+            s = _word_set(b[yomi])
+            words = [x for x in a[yomi] if x not in s]
             if words:
                 d[yomi] = words
         else:
-            d[yomi] = a[yomi][:]
+            d[yomi] = list(a[yomi])
     return d
 
 
@@ -431,10 +501,62 @@ def intersection_yomi(a, b):
     d = {}
     for yomi in set(a) & set(b):
         assert yomi in a and yomi in b
-        d[yomi] = a[yomi] + [x for x in b[yomi] if x not in a[yomi]]
+        s = _word_set(a[yomi])
+        d[yomi] = list(a[yomi]) + [x for x in b[yomi] if x not in s]
     return d
 
 
+# よみごとに語の集合をもつ辞書です。
+# 語の集合には追加した順序をたもつdictをつかうので、語の有無はO(1)でしらべられます。
+# 辞書の演算はその場でおこない、あたらしい辞書をつくりません。
+# outputやkigouなどの関数には、ふつうの辞書とおなじようにわたせます。
+class WordSetDict(dict):
+    def __init__(self, other=None):
+        super().__init__()
+        if other:
+            for yomi, words in other.items():
+                self[yomi] = dict.fromkeys(words)
+
+    def copy(self):
+        return WordSetDict(self)
+
+    def add_word(self, yomi, word):
+        self.setdefault(yomi, {})[word] = None
+
+    # 辞書bの語を末尾に追加します。
+    def union_update(self, b):
+        for yomi, words in b.items():
+            s = self.get(yomi)
+            if s is None:
+                self[yomi] = dict.fromkeys(words)
+            else:
+                s.update(dict.fromkeys(words))
+
+    # 辞書bの語をとりのぞきます。
+    def difference_update(self, b):
+        for yomi, words in b.items():
+            s = self.get(yomi)
+            if s is None:
+                continue
+            for word in words:
+                s.pop(word, None)
+            if not s:
+                del self[yomi]
+
+    # 辞書bにない語をとりのぞきます。
+    def intersection_update(self, b):
+        for yomi in list(self):
+            if yomi not in b:
+                del self[yomi]
+                continue
+            s = self[yomi]
+            t = _word_set(b[yomi])
+            for word in [x for x in s if x not in t]:
+                del s[word]
+            if not s:
+                del self[yomi]
+
+
 # 記号をつかっている語をとりだします。
 def kigou(dict):
     d = {}
@@ -525,7 +647,99 @@ def mix_yougen(dict):
     return d
 
 
-def _is_hyounai_yomi(zyouyou, yomi, word):
+# 促音化をゆるす、よみの末尾の字の種類
+SOKUON_KI = 0x01    # き、く
+SOKUON_TI = 0x02    # ち、つ
+
+
+def _sokuon_tail(c):
+    if 0 <= 'きくキク'.find(c):
+        return SOKUON_KI
+    if 0 <= 'ちつチツ'.find(c):
+        return SOKUON_TI
+    return 0
+
+
+def _sokuon_head(c):
+    if 0 <= 'かきくけこカキクケコ'.find(c):
+        return SOKUON_KI | SOKUON_TI
+    if 0 <= 'さしすせそサシスセソたちつてとタチツテトはひふへほハヒフヘホ'.find(c):
+        return SOKUON_TI
+    return 0
+
+
+# 字のよみひとつです。清音化したよみと、促音化をしらべるための先頭と末尾の字の種類をもちます。
+class _Yomi:
+    __slots__ = ('seion', 'head', 'tail', 'tail_seion')
+
+    def __init__(self, yomi):
+        self.seion = to_seion(yomi)
+        self.head = _sokuon_head(yomi[0])
+        self.tail = _sokuon_tail(yomi[-1])
+        self.tail_seion = _sokuon_tail(self.seion[-1])
+
+
+# 漢字のよみの表から、字ごとに清音化したよみをまとめた索引です。
+# 索引は学年ごとにいちどだけつくり、字ごとのよみは最初につかったときに用意します。
+class _YomiIndex:
+    def __init__(self, table):
+        self.table = table
+        self._yomi = {}
+
+    def __contains__(self, c):
+        return c in self.table
+
+    def get(self, c):
+        yomi = self._yomi.get(c)
+        if yomi is None:
+            yomi = self._yomi[c] = tuple(_Yomi(y) for y in self.table[c])
+        return yomi
+
+
+_yomi_indexes = {}
+
+
+# keyの索引をかえします。はじめてのときはload()でよみの表をつくります。
+def _get_yomi_index(key, load):
+    index = _yomi_indexes.get(key)
+    if index is None:
+        index = _yomi_indexes[key] = _YomiIndex(load())
+    return index
+
+
+# 清音化したよみyomiが、字ごとのよみの列yomi_listを順につなげたものになるかどうかをしらべます。
+# 前の字のよみが「き」「く」「ち」「つ」でおわり、後の字のよみが
+# か行、さ行、た行、は行ではじまるときは、促音化したよみもゆるします。
+def _match_yomi(yomi, yomi_list):
+    n = len(yomi)
+    exact = set()   # よみの先頭からここまで一致している位置
+    sokuon = {}     # 直前の字が「っ」に一致していて、促音化すれば一致する位置
+    first = True
+    for candidates in yomi_list:
+        next_exact = set()
+        next_sokuon = {}
+        for p in (exact | sokuon.keys()) if not first else (0,):
+            mask = sokuon.get(p, 0)
+            for y in candidates:
+                if not first and p not in exact and not (mask & y.head):
+                    continue
+                q = p + len(y.seion)
+                if n < q:
+                    continue
+                if yomi.startswith(y.seion, p):
+                    next_exact.add(q)
+                tail = y.tail if first else y.tail_seion
+                if tail and 2 <= q and yomi[q - 1] == 'つ' and yomi.startswith(y.seion[:-1], p):
+                    next_sokuon[q] = next_sokuon.get(q, 0) | tail
+        exact = next_exact
+        sokuon = next_sokuon
+        first = False
+        if not exact and not sokuon:
+            return False
+    return n in exact
+
+
+def _is_hyounai_yomi(index, yomi, word):
     # ― と # をとりのぞく。
     yomi = yomi.replace('―', '')
     yomi = yomi.replace('#', '')
@@ -543,70 +757,58 @@ def _is_hyounai_yomi(zyouyou, yomi, word):
         if yomi.endswith(okuri):
             yomi = yomi[:-(len(okuri))]
 
-    if len(word) == 1:
-        if word not in zyouyou:
-            return False
-        for i in zyouyou[word]:
-            if to_seion(yomi) == to_seion(i):
-                return True
-        return False
     c = word[0]
-    if c not in zyouyou:
+    if c not in index:
         return False
-    s = zyouyou[c]
+    yomi_list = [index.get(c)]
     b = c
     for c in word[1:]:
         if c == '々':
             if b == c:
                 # e.g. 個人々々
                 return False
-            t = set(itertools.product(s, zyouyou[b]))
+            yomi_list.append(index.get(b))
         elif RE_KANA.match(c):
-            t = set(itertools.product(s, set(c)))
-        elif c not in zyouyou:
+            yomi_list.append((_Yomi(c),))
+        elif c not in index:
             return False
         else:
-            t = set(itertools.product(s, zyouyou[c]))
-        s = set()
-        for y in t:
-            s.add(to_seion(''.join(y)))
-            if 2 <= len(y[0]):
-                # 促音化の許容
-                if (0 <= 'きくキク'.find(y[0][-1]) and 0 <= 'かきくけこカキクケコ'.find(y[1][0])
-                    or 0 <= 'ちつチツ'.find(y[0][-1])
-                        and 0 <= 'かきくけこカキクケコさしすせそサシスセソたちつてとタチツテトはひふへほハヒフヘホ'.find(y[1][0])):
-                    s.add(to_seion(y[0][0:-1] + 'つ' + y[1]))
+            yomi_list.append(index.get(c))
         b = c
-    return to_seion(yomi) in s
+    return _match_yomi(to_seion(yomi), yomi_list)
+
+
+# 常用漢字表から、学年までにならう漢字のよみの表をつくります。
+def _load_hyounai(grade):
+    zyouyou = {}
+    for row in _zyouyou_rows():
+        kanji = row[0]
+        s = set()
+        for yomi in row[1:]:
+            g = int(yomi[-1])
+            if grade < g:
+                continue
+            yomi = yomi[:-2]
+            yomi = yomi.strip('（）')
+            pos = yomi.find('―')
+            if 0 <= pos:
+                yomi = yomi[:pos]
+            if not yomi:
+                continue
+            s.add(to_hiragana(yomi))
+        if s:
+            zyouyou[kanji] = s
+    return zyouyou
 
 
 # 表外のよみかたをつかっている熟語をとりだします。
 def hyougai_yomi(dict, grade=10):
-    zyouyou = {}
-    with open(toolpath('zyouyou-kanji.csv'), 'r') as f:
-        for row in f:
-            row = row.strip().split(',')
-            kanji = row[0]
-            s = set()
-            for yomi in row[1:]:
-                g = int(yomi[-1])
-                if grade < g:
-                    continue
-                yomi = yomi[:-2]
-                yomi = yomi.strip('（）')
-                pos = yomi.find('―')
-                if 0 <= pos:
-                    yomi = yomi[:pos]
-                if not yomi:
-                    continue
-                s.add(to_hiragana(yomi))
-            if s:
-                zyouyou[kanji] = s
+    index = _get_yomi_index(('hyounai', grade), lambda: _load_hyounai(grade))
     d = {}
     for yomi, words in dict.items():
         s = []
         for word in words:
-            if not _is_hyounai_yomi(zyouyou, yomi, word):
+            if not _is_hyounai_yomi(index, yomi, word):
                 s.append(word)
         if s:
             d[yomi] = s
@@ -617,57 +819,55 @@ def hyougai_yomi(dict, grade=10):
 def load_onkun(grade=10, okuri=True, drop=False):
     kunyomi = {}
     onyomi = {}
-    with open(toolpath('zyouyou-kanji.csv'), 'r') as f:
-        for row in f:
-            row = row.strip().split(',')
-            kanji = row[0]
-            on = set()
-            kun = set()
-            for yomi in row[1:]:
-                g = int(yomi[-1])
-                if grade < g:
+    for row in _zyouyou_rows():
+        kanji = row[0]
+        on = set()
+        kun = set()
+        for yomi in row[1:]:
+            g = int(yomi[-1])
+            if grade < g:
+                continue
+            yomi = yomi[:-2]
+            yomi = yomi.strip('（）')
+            pos = yomi.find('―')
+            if 0 <= pos:
+                if okuri:
+                    yomi = yomi[:pos]
+                else:
                     continue
-                yomi = yomi[:-2]
-                yomi = yomi.strip('（）')
-                pos = yomi.find('―')
-                if 0 <= pos:
-                    if okuri:
-                        yomi = yomi[:pos]
-                    else:
-                        continue
-                if yomi:
-                    if RE_ONYOMI.search(yomi):
-                        on.add(to_hiragana(yomi))
-                    else:
-                        kun.add(yomi)
-
-            if drop:
-                intersection = kun & on
-                kun -= intersection
-                on -= intersection
-
-            if kun:
-                kunyomi[kanji] = kun
-            if on:
-                onyomi[kanji] = on
+            if yomi:
+                if RE_ONYOMI.search(yomi):
+                    on.add(to_hiragana(yomi))
+                else:
+                    kun.add(yomi)
+
+        if drop:
+            intersection = kun & on
+            kun -= intersection
+            on -= intersection
+
+        if kun:
+            kunyomi[kanji] = kun
+        if on:
+            onyomi[kanji] = on
     return onyomi, kunyomi
 
 
 # 和語の熟語をとりだします。
 def wago(dict, grade=10, okuri=True):
-    onyomi, kunyomi = load_onkun(grade, okuri)
+    index = _get_yomi_index(('kun', grade, okuri, False), lambda: load_onkun(grade, okuri)[1])
     d = {}
     for yomi, words in dict.items():
         s = []
         for word in words:
-            if _is_hyounai_yomi(kunyomi, yomi, word):
+            if _is_hyounai_yomi(index, yomi, word):
                 s.append(word)
         if s:
             d[yomi] = s
     return d
 
 
-def _is_maze_yomi(first: dict, second: dict, yomi, word):
+def _is_maze_yomi(first, second, yomi, word):
     # ― と # をとりのぞく。
     yomi = yomi.replace('―', '')
     yomi = yomi.replace('#', '')
@@ -686,30 +886,26 @@ def _is_maze_yomi(first: dict, second: dict, yomi, word):
     c = word[0]
     if c not in first:
         return False
-    s = first[c]
+    s = first.get(c)
 
     c = word[1]
     if c == '々':
         return False
     if c not in second:
         return False
-    t = set(itertools.product(s, second[c]))
-    s = set()
-    for y in t:
-        s.add(to_seion(''.join(y)))
-        if 2 <= len(y[0]):
-            # 促音化の許容
-            if (0 <= 'きくキク'.find(y[0][-1]) and 0 <= 'かきくけこカキクケコ'.find(y[1][0])
-                or 0 <= 'ちつチツ'.find(y[0][-1])
-                    and 0 <= 'かきくけこカキクケコさしすせそサシスセソたちつてとタチツテトはひふへほハヒフヘホ'.find(y[1][0])):
-                s.add(to_seion(y[0][0:-1] + 'つ' + y[1]))
+    return _match_yomi(to_seion(yomi), [s, second.get(c)])
+
 
-    return to_seion(yomi) in s
+# 音よみと訓よみをわけた索引をかえします。音と訓の両方にあるよみはのぞきます。
+def _onkun_index(grade, okuri):
+    onyomi = _get_yomi_index(('on', grade, okuri, True), lambda: load_onkun(grade, okuri, drop=True)[0])
+    kunyomi = _get_yomi_index(('kun', grade, okuri, True), lambda: load_onkun(grade, okuri, drop=True)[1])
+    return onyomi, kunyomi
 
 
 # 重箱よみの語をとりだします。
 def zyuubako(dict, grade=10, okuri=True):
-    onyomi, kunyomi = load_onkun(grade, okuri, drop=True)
+    onyomi, kunyomi = _onkun_index(grade, okuri)
     d = {}
     for yomi, words in dict.items():
         s = []
@@ -723,7 +919,7 @@ def zyuubako(dict, grade=10, okuri=True):
 
 # 湯桶よみの語をとりだします。
 def yutou(dict, grade=10, okuri=True):
-    onyomi, kunyomi = load_onkun(grade, okuri, drop=True)
+    onyomi, kunyomi = _onkun_index(grade, okuri)
     d = {}
     for yomi, words in dict.items():
         s = []
@@ -737,7 +933,7 @@ def yutou(dict, grade=10, okuri=True):
 
 # 重箱よみと湯桶よみの語をとりだします。
 def mazeyomi(dict, grade=10, okuri=True):
-    onyomi, kunyomi = load_onkun(grade, okuri, drop=True)
+    onyomi, kunyomi = _onkun_index(grade, okuri)
     d = {}
     for yomi, words in dict.items():
         s = []
@@ -752,21 +948,19 @@ def mazeyomi(dict, grade=10, okuri=True):
 # 許容されているおくりがなをとりだします。
 def permissible():
     dict = {}
-    with open(toolpath('zyouyou-kanji.csv'), 'r') as file:
-        for row in file:
-            row = row.strip().split(',')
-            kanji = row[0]
-            for yomi in row[1:]:
-                if int(yomi[-1]) < 9:
-                    continue
-                yomi = yomi[:-2]
-                yomi = yomi.strip('（）')
-                yomi = to_hiragana(yomi)
-                pos = yomi.find('―')
-                if pos < 0:
-                    continue
-                assert 1 < pos
-                word = kanji + yomi[pos + 1:]
-                yomi = yomi[:pos + 1]
-                add_word(dict, yomi, word)
+    for row in _zyouyou_rows():
+        kanji = row[0]
+        for yomi in row[1:]:
+            if int(yomi[-1]) < 9:
+                continue
+            yomi = yomi[:-2]
+            yomi = yomi.strip('（）')
+            yomi = to_hiragana(yomi)
+            pos = yomi.find('―')
+            if pos < 0:
+                continue
+            assert 1 < pos
+            word = kanji + yomi[pos + 1:]
+            yomi = yomi[:pos + 1]
+            add_word(dict, yomi, word)
     return dict
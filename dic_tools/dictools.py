@@ -15,9 +15,19 @@
 # limitations under the License.
 
 import argparse
+import concurrent.futures
+import contextlib
+import os
 import sys
 
 import diclib
+import katakana
+import permissible
+import restrain
+from toolpath import toolpath
+
+# restrain.pyでつかう辞書です。プロセスごとにいちどだけよみこみます。
+_sources = None
 
 
 def get_header(filename):
@@ -47,6 +57,44 @@ def output_dic(dic, args, unparsed, header=''):
             output_inner(dic, args, unparsed, header, file)
 
 
+def _get_sources(path):
+    global _sources
+    if _sources is None:
+        _sources = restrain.load_sources(path)
+    return _sources
+
+
+def _build_restrained(path, grade):
+    restrain.output(path, restrain.restrain(_get_sources(path), grade))
+
+
+def _build_target(outdir, name, generate, *args):
+    with open(os.path.join(outdir, name), 'w') as file:
+        with contextlib.redirect_stdout(file):
+            generate(*args)
+    return name
+
+
+# ひらがなIMEの辞書をすべて、プロセスプールで並列に生成します。
+# 出力先のディレクトリーは -o で指定します。
+def build(args, unparsed, output):
+    outdir = args.output if args.output else '.'
+    skk = toolpath('third_party/skk/SKK-JISYO.ML')
+    targets = [
+        ('katakana.dic', katakana.generate, toolpath('third_party/edrdg/edict2'), toolpath('drop.katakana.dic')),
+        ('permissible.dic', permissible.generate, toolpath('permissible_9.dic')),
+    ]
+    for grade in range(9, 0, -1):
+        targets.append((f'restrained.{grade}.dic', _build_restrained, skk, grade))
+
+    # forkでつくられるワーカーは、よみこみずみの辞書をひきつぎます。
+    _get_sources(skk)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(_build_target, outdir, *target) for target in targets]
+        for future in futures:
+            future.result()
+
+
 def diff(args, unparsed, output):
     dic = {}
     op = ''
@@ -168,7 +216,9 @@ def zyuubako(args, unparsed, output):
 
 
 def dispatch(args, unparsed, output):
-    if args.command == 'diff':
+    if args.command == 'build':
+        build(args, unparsed, output)
+    elif args.command == 'diff':
         diff(args, unparsed, output)
     elif args.command == 'hyougai':
         hyougai(args, unparsed, output)
@@ -199,6 +249,7 @@ def dispatch(args, unparsed, output):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('command', choices=[
+        'build',
         'diff',
         'hyougai',
         'hyougai-yomi',
@@ -215,6 +266,7 @@ def main():
     ])
     parser.add_argument('-o', '--output')
     parser.add_argument('--header', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int)
     parser.add_argument('--single', action='store_true')
     args, unparsed = parser.parse_known_args()
     dispatch(args, unparsed, sys.stdout)
@@ -24,25 +24,29 @@ RE_KATAKANA = re.compile(r'[ァ-ー]{2,}')
 copyright = ''
 
 
-def load(path):
-    global copyright
-    dic = {}
+# EDICT2の著作権表示をとりだします。
+def read_copyright(path):
     with open(path, encoding='euc_jp') as f:
         for row in f:
             row = row.strip(' \n')
-            if not row:
-                continue
-            if not copyright:
-                pos = row.find('EDICT2')
-                if 0 < pos:
-                    copyright = row[pos:].strip(' \n/').split('/')
-            if not RE_KATAKANA.match(row):
+            pos = row.find('EDICT2')
+            if 0 < pos:
+                return row[pos:].strip(' \n/').split('/')
+    return ''
+
+
+# EDICT2を一行ずつよみながら、カタカナ語のよみと語の組を順にかえします。
+# おなじ組をくりかえしかえすことがあります。
+def parse(path):
+    with open(path, encoding='euc_jp') as f:
+        for row in f:
+            row = row.strip(' \n')
+            if not row or not RE_KATAKANA.match(row):
                 continue
             row = row.split(' ', 1)
             words = row[0].strip().split(';')
             if '(ain:)' in row[1]:
                 continue
-            yomi = []
             for word in words:
                 # see https://www.edrdg.org/jmwsgi/edhelp.py?svc=jmdict
                 if word.endswith('(ik)'):     # word containing irregular kana usage
@@ -53,26 +57,22 @@ def load(path):
                     continue
                 if word.endswith('(sk)'):     # search-only kana form
                     continue
-                yomi.extend(word.split('・'))
-            for i in yomi:
-                found = RE_KATAKANA.match(i)
-                if found:
-                    word = found.group()
-                    diclib.add_word(dic, diclib.to_hiragana(word), word)
-    return dic
+                for i in word.split('・'):
+                    found = RE_KATAKANA.match(i)
+                    if found:
+                        katakana = found.group()
+                        yield diclib.to_hiragana(katakana), katakana
 
 
 # EDICT2 ファイルからカタカナ辞書を生成して出力します。
-def main():
+# dropにある語はのぞきます。
+def generate(path, drop=None):
     global copyright
-
-    path = 'edict2'
-    if 2 <= len(sys.argv):
-        path = sys.argv[1]
-    dic = load(path)
-
-    if 3 <= len(sys.argv):
-        dic = diclib.difference(dic, diclib.load(sys.argv[2]))
+    entries = diclib.cached_parse(_parse_entries, path)
+    copyright = read_copyright(path)
+    if drop:
+        excluded = diclib.load(drop)
+        entries = [(yomi, word) for yomi, word in entries if word not in excluded.get(yomi, ())]
 
     print(';; Hiragana IME for IBus')
     print(';; Copyright (c) 2017-2024 Esrille Inc.')
@@ -92,7 +92,25 @@ def main():
     print(';;')
     print(';;   https://www.edrdg.org/jmdict/edict.html')
     print(';;')
-    diclib.output(dic, single=True)
+    for yomi, word in entries:
+        print(f'{yomi} /{word}/')
+
+
+# 重複をのぞいて、よみの順にならべたカタカナ語の組をかえします。
+# カタカナ語はよみからきまるので、よみごとの語の辞書をつくる必要はありません。
+def _parse_entries(path):
+    return sorted(set(parse(path)))
+
+
+# katakana.py [EDICT2 [drop.katakana.dic]]
+def main():
+    path = 'edict2'
+    if 2 <= len(sys.argv):
+        path = sys.argv[1]
+    drop = None
+    if 3 <= len(sys.argv):
+        drop = sys.argv[2]
+    generate(path, drop)
 
 
 if __name__ == '__main__':
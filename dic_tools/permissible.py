@@ -19,7 +19,8 @@ import sys
 import diclib
 
 
-def main():
+# 許容されているおくりがなの辞書をつくって出力します。
+def generate(path):
     # ヘッダーを出力します。
     print(';; Hiragana IME for IBus')
     print(';; Copyright (c) 2024 Esrille Inc.')
@@ -27,9 +28,13 @@ def main():
     print(';;   https://github.com/esrille/ibus-hiragana')
     print(';;')
     permissible = diclib.permissible()
-    permissible = diclib.union(permissible, diclib.load(sys.argv[1]))
+    permissible = diclib.union(permissible, diclib.load(path))
     diclib.output(permissible)
 
 
+def main():
+    generate(sys.argv[1])
+
+
 if __name__ == '__main__':
     main()
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import os
 import sys
 
@@ -21,13 +22,9 @@ import diclib
 from toolpath import toolpath
 
 
-def main():
-    path = toolpath('third_party/skk/SKK-JISYO.ML')
-    if 2 <= len(sys.argv):
-        path = sys.argv[1]
-    grade = 9
-    if 3 <= len(sys.argv):
-        grade = int(sys.argv[2])
+# 学年によらない辞書とその部分を、いちどだけよみこんでつくります。
+def load_sources(path):
+    src = {}
 
     # もとにするSKK辞書をよみこむ
     skk = diclib.load(path)
@@ -42,41 +39,67 @@ def main():
     reigai = diclib.union(reigai, diclib.load(toolpath('tc2.compat.dic')))
     reigai = diclib.union(reigai, diclib.kigou(skk))
     reigai = diclib.union(diclib.load(toolpath('reigai.dic')), reigai)  # 独自に追加したい語を追加
-    if grade <= 6:
-        reigai = diclib.difference(reigai, diclib.hyougai(reigai))
-        reigai = diclib.difference(reigai, diclib.hyougai_yomi(reigai, grade))
+    src['reigai'] = reigai
+    src['reigai_6'] = diclib.difference(reigai, diclib.hyougai(reigai))
 
-    # 基本辞書をつくります。
+    # 基本辞書のもとをつくります。
     dict = diclib.difference(skk, diclib.load(toolpath('drop_6.dic')))
     dict = diclib.difference(dict, diclib.zyouyou(9))                  # 常用漢字をいったん削除
     dict = diclib.union(dict, diclib.load(toolpath('add_6.dic')))
+    src['dict'] = dict
+
+    for name in ('add_7', 'add_8', 'add_9', 'zyosuusi', 'greek', 'drop'):
+        src[name] = diclib.load(toolpath(name + '.dic'))
+    src['permissible'] = diclib.permissible()
+    return src
+
+
+# 辞書aの語を辞書bの語のまえにおいた辞書をかえします。
+def _prepend(a, b):
+    d = diclib.WordSetDict(a)
+    d.union_update(b)
+    return d
+
+
+# 学年別の辞書をつくります。
+def restrain(src, grade):
+    reigai = src['reigai']
+    if grade <= 6:
+        reigai = src['reigai_6']
+        reigai = diclib.difference(reigai, diclib.hyougai_yomi(reigai, grade))
+
+    # 基本辞書をつくります。
+    dict = diclib.WordSetDict(src['dict'])
     if 7 <= grade:
-        dict = diclib.union(dict, diclib.load(toolpath('add_7.dic')))
+        dict.union_update(src['add_7'])
     if 8 <= grade:
-        dict = diclib.union(dict, diclib.load(toolpath('add_8.dic')))
-    dict = diclib.difference(dict, reigai)                              # 例外辞書の内容を削除
-    dict = diclib.difference(dict, diclib.okuri(dict))                  # おくりがなのついた語を削除
-    dict = diclib.difference(dict, diclib.hyougai_yomi(dict, grade))    # 表外のよみかたをつかっている語を削除
-    dict = diclib.difference(dict, diclib.wago(dict, grade))            # 和語の語を削除
-    dict = diclib.difference(dict, diclib.mazeyomi(dict, grade))        # 重箱よみと湯桶よみの語を削除
+        dict.union_update(src['add_8'])
+    dict.difference_update(reigai)                                      # 例外辞書の内容を削除
+    dict.difference_update(diclib.okuri(dict))                          # おくりがなのついた語を削除
+    dict.difference_update(diclib.hyougai_yomi(dict, grade))            # 表外のよみかたをつかっている語を削除
+    dict.difference_update(diclib.wago(dict, grade))                    # 和語の語を削除
+    dict.difference_update(diclib.mazeyomi(dict, grade))                # 重箱よみと湯桶よみの語を削除
     if 9 <= grade:
         # おとな用の辞書では漢字制限をゆるめておきます。
-        dict = diclib.union(dict, diclib.load(toolpath('add_9.dic')))
-    dict = diclib.difference(dict, diclib.hyougai(dict))                # 表外の漢字を使用している語を削除
+        dict.union_update(src['add_9'])
+    dict.difference_update(diclib.hyougai(dict))                        # 表外の漢字を使用している語を削除
     huhyou = diclib.load_huhyou(toolpath('huhyou.dic'), grade)
-    dict = diclib.union(diclib.zyouyou(grade, exclude_special=True), dict)  # 常用漢字を追加
-    dict = diclib.union(huhyou, dict)                                   # 常用漢字表・付表の語を追加
-    dict = diclib.difference(dict, diclib.permissible())                # 許容されているおくりがなを削除
-    zyosuusi = diclib.load(toolpath('zyosuusi.dic'))
+    dict = _prepend(diclib.zyouyou(grade, exclude_special=True), dict)  # 常用漢字を追加
+    dict = _prepend(huhyou, dict)                                       # 常用漢字表・付表の語を追加
+    dict.difference_update(src['permissible'])                          # 許容されているおくりがなを削除
+    zyosuusi = src['zyosuusi']
     zyosuusi = diclib.difference(zyosuusi, diclib.hyougai_yomi(zyosuusi, grade))
-    dict = diclib.union(zyosuusi, dict)                                 # 助数詞を先頭に追加
+    dict = _prepend(zyosuusi, dict)                                     # 助数詞を先頭に追加
 
     # 例外辞書をマージします。
-    dict = diclib.union(dict, reigai)
+    dict.union_update(reigai)
     if 6 < grade:
-        dict = diclib.union(dict, diclib.load(toolpath('greek.dic')))   # ギリシア文字を追加。
-    dict = diclib.difference(dict, diclib.load(toolpath('drop.dic')))   # 独自に削除したい語を削除。
+        dict.union_update(src['greek'])                                 # ギリシア文字を追加。
+    dict.difference_update(src['drop'])                                 # 独自に削除したい語を削除。
+    return dict
+
 
+def output(path, dict):
     # ヘッダーを出力します。
     print(';; Hiragana IME for IBus')
     print(';; Copyright (c) 2017-2024 Esrille Inc.')
@@ -92,5 +115,27 @@ def main():
     diclib.output(dict)
 
 
+# restrain.py [SKK辞書 [学年]]
+# restrain.py SKK辞書 all [出力先のディレクトリー]
+#   学年に'all'を指定すると、restrained.1.dicからrestrained.9.dicまでを
+#   いちどにつくります。
+def main():
+    path = toolpath('third_party/skk/SKK-JISYO.ML')
+    if 2 <= len(sys.argv):
+        path = sys.argv[1]
+    grade = '9'
+    if 3 <= len(sys.argv):
+        grade = sys.argv[2]
+    src = load_sources(path)
+    if grade != 'all':
+        output(path, restrain(src, int(grade)))
+        return
+    outdir = sys.argv[3] if 4 <= len(sys.argv) else '.'
+    for grade in range(1, 10):
+        with open(os.path.join(outdir, f'restrained.{grade}.dic'), 'w') as f:
+            with contextlib.redirect_stdout(f):
+                output(path, restrain(src, grade))
+
+
 if __name__ == '__main__':
     main()
@@ -16,15 +16,33 @@
 
 from __future__ import annotations
 
+import heapq
 import logging
+import math
 import os
 import re
+import threading
+import time
 
 import package
+import tracing
 
 LOGGER = logging.getLogger(__name__)
 
 DICTIONARY_VERSION = 'v1.0.0'
+HISTORY_VERSION = 'v2.0.0'
+
+# The input history records the decayed count and the last time of use of
+# each word. The count is halved every HISTORY_HALF_LIFE seconds, and the
+# word is no longer ranked ahead of the others once the count falls below
+# HISTORY_MIN_COUNT. The words are evicted only when the history has more
+# than history_size words.
+HISTORY_HALF_LIFE = 7 * 24 * 60 * 60
+HISTORY_MIN_COUNT = 0.5
+HISTORY_SIZE = 10000
+# The count given to the words converted from the orders file of v1.0.0 so
+# that they are ranked for a month.
+HISTORY_IMPORT_COUNT = 8.0
 
 # Constants used for Hiragana - Katakana conversion
 HIRAGANA = ('あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわゐゑをん'
@@ -64,6 +82,52 @@ DAKUON = 'がぎぐげござじずぜぞだぢづでどばびぶべぼ'
 SEION = 'かきくけこさしすせそたちつてとはひふへほ'
 RE_PREFIX = re.compile(f'^[{HIRAGANA}]+')
 
+# The base dictionaries shared among Dictionary instances:
+#   _system_base: (key, dictionary, max_len)
+#   _user_base: (key, dictionary, max_len, user dictionary entries)
+_system_base = (None, {}, 0)
+_user_base = (None, {}, 0, {})
+_base_lock = threading.Lock()
+
+
+def _history_count(count: float, last: int, now: int) -> float:
+    return count * 0.5 ** (max(0, now - last) / HISTORY_HALF_LIFE)
+
+
+def _history_score(count: float, last: int) -> float:
+    # log2 of the count decayed until a common time, so that the scores of the
+    # words used at different times can be compared.
+    return math.log2(count) + last / HISTORY_HALF_LIFE
+
+
+def _get_paths(system: str, user: str, permissible: bool) -> (list[str], str):
+    dir_path = os.path.join(package.get_datadir(), 'dic')
+
+    # Load Katakana dictionary first so that Katakana words come after Kanji words.
+    paths = [os.path.join(dir_path, 'katakana.dic')]
+    if permissible and system == 'restrained.9.dic':
+        paths.append(os.path.join(dir_path, 'permissible.dic'))
+    # Load system dictionary
+    paths.append(os.path.join(dir_path, system))
+
+    # Load user dictionary
+    user_path = ''
+    if user:
+        path = os.path.join(package.get_user_datadir(), user)
+        if os.path.abspath(path) == path:
+            user_path = path
+    return paths, user_path
+
+
+def _get_layer_key(paths: list[str]) -> tuple:
+    key = []
+    for path in paths:
+        try:
+            key.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            key.append((path, -1))
+    return tuple(key)
+
 
 class Dictionary:
 
@@ -89,8 +153,9 @@ class Dictionary:
 
     def __init__(self, system: str, user: str,
                  clear_history: bool = False,
-                 permissible: bool = False):
-        LOGGER.debug(f'Dictionary("{system}", "{user}", {clear_history}, {permissible})')
+                 permissible: bool = False,
+                 history_size: int = HISTORY_SIZE):
+        LOGGER.debug(f'Dictionary("{system}", "{user}", {clear_history}, {permissible}, {history_size})')
 
         self._dict_base = {}
         self._dict = {}
@@ -108,67 +173,170 @@ class Dictionary:
         self._shrunk = ''   # shrunk word by using LLM
         self._rejected = {}  # ignored shrunk words
 
-        self._orders_path = ''
-
-        dir_path = os.path.join(package.get_datadir(), 'dic')
-
-        try:
-            # Load Katakana dictionary first so that Katakana words come after Kanji words.
-            path = os.path.join(dir_path, 'katakana.dic')
-            self._load_dict(self._dict_base, path)
-        except OSError:
-            LOGGER.exception('Could not load "katakana.dic"')
+        self._history = {}  # yomi: {word: (count, last)}
+        self._history_size = history_size
+        self._history_path = ''
+        self._strings = {}  # string table used while loading dictionaries
 
-        if permissible and system == 'restrained.9.dic':
-            try:
-                path = os.path.join(dir_path, 'permissible.dic')
-                self._load_dict(self._dict_base, path)
-            except OSError:
-                LOGGER.exception('Could not load "permissible.dic"')
+        paths, user_path = _get_paths(system, user, permissible)
+        self._user_path = user_path
+        self._user_entries = {}
+        self._system_key = None
+        self._dict_base, self._max_len = self._load_base(paths, user_path)
 
-        try:
-            # Load system dictionary
-            path = os.path.join(dir_path, system)
-            self._load_dict(self._dict_base, path)
-        except OSError:
-            LOGGER.exception(f'Could not load "{path}"')
-
-        # Load user dictionary
-        if user:
-            path = os.path.join(package.get_user_datadir(), user)
-            if os.path.abspath(path) == path:
-                try:
-                    self._load_dict(self._dict_base, path)
-                except OSError:
-                    LOGGER.exception(f'Could not load "{path}"')
-
-        # Create the working dictionary
+        # Create the working dictionary. The candidate tuples are shared with
+        # self._dict_base until they are replaced by the input history.
         self._dict = self._dict_base.copy()
 
         # Load input history
-        self._orders_path = os.path.join(package.get_user_datadir(), 'dic', system)
+        self._history_path = os.path.join(package.get_user_datadir(), 'dic', system)
         try:
             if clear_history:
                 LOGGER.debug('clear_history')
-                with open(self._orders_path, 'w') as f:
-                    f.write(f'; {DICTIONARY_VERSION}\n')
+                with open(self._history_path, 'w') as f:
+                    f.write(f'; {HISTORY_VERSION}\n')
             else:
-                self._load_dict(self._dict, self._orders_path, 'a+', version_checked=False)
+                self._load_history(self._history_path)
+        except OSError:
+            LOGGER.exception(f'Could not load "{self._history_path}"')
+
+        self._strings = {}
+
+    @classmethod
+    def load_base(cls, system: str, user: str, permissible: bool = False):
+        # Load only the base dictionaries shared by the instances, without the
+        # working dictionary and the input history, e.g., to prewarm them.
+        self = cls.__new__(cls)
+        self._max_len = 0
+        self._strings = {}
+        self._load_base(*_get_paths(system, user, permissible))
+
+    def _load_base(self, paths: list[str], user_path: str) -> (dict[str, tuple[str, ...]], int):
+        # Reuse the base dictionaries loaded by other Dictionary instances
+        # unless the files have been modified since, so that only the changed
+        # layer is merged again.
+        global _system_base, _user_base
+
+        with _base_lock:
+            key = _get_layer_key(paths)
+            if _system_base[0] != key:
+                base = {}
+                self._max_len = 0
+                for path in paths:
+                    self._load_dict(base, path)
+                _system_base = (key, base, self._max_len)
+            user_key = (key, _get_layer_key([user_path] if user_path else []))
+            if _user_base[0] != user_key:
+                _, base, self._max_len = _system_base
+                entries = {}
+                if user_path:
+                    base = base.copy()
+                    self._load_dict(base, user_path)
+                    entries = self._read_entries(user_path)
+                _user_base = (user_key, base, self._max_len, entries)
+            self._system_key = key
+            self._user_entries = _user_base[3]
+            return _user_base[1], _user_base[2]
+
+    def _read_entries(self, path: str) -> dict[str, tuple[str, ...]]:
+        # Read the entries of the user dictionary merging the lines of the same reading.
+        entries = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip(' \n/')
+                    if not line or line[0] == ';':
+                        continue
+                    words = line.split(' ', 1)
+                    if len(words) < 2:
+                        continue
+                    yomi = words[0]
+                    words = words[1].strip(' \n/').split('/')
+                    entries[yomi] = tuple(dict.fromkeys(entries.get(yomi, ()) + tuple(words)))
         except OSError:
-            LOGGER.exception(f'Could not load "{self._orders_path}"')
+            LOGGER.warning(f'could not read "{path}"')
+        return entries
+
+    def _update_entries(self, dic: dict[str, tuple[str, ...]], system: dict[str, tuple[str, ...]],
+                        entries: dict[str, tuple[str, ...]], yomi: str):
+        old = self._user_entries.get(yomi, ())
+        new = entries.get(yomi, ())
+        removed = [word for word in old if word not in new and word not in system.get(yomi, ())]
+        if removed:
+            self._remove_entries(dic, yomi, removed)
+        if new:
+            self._merge_entry(dic, yomi, list(new))
+        if yomi.endswith('―'):
+            if new:
+                self._merge_entry(dic, yomi[:-1], [yomi])
+            elif yomi not in system:
+                self._remove_entries(dic, yomi[:-1], [yomi])
+
+    def update_user_dictionary(self) -> bool | None:
+        """Apply the changes made in the user dictionary file.
+
+        Only the readings whose entries have been changed are merged again.
+        Return False if the dictionary needs to be reloaded instead, or None
+        if the base dictionaries are being loaded and it should be retried.
+        """
+        global _user_base
+
+        if not self._user_path:
+            return True
+        if not _base_lock.acquire(blocking=False):
+            return None
+        try:
+            key = self._system_key
+            if _system_base[0] != key:
+                return False
+            user_key = (key, _get_layer_key([self._user_path]))
+            if _user_base[0] == user_key:
+                entries = _user_base[3]
+            else:
+                entries = self._read_entries(self._user_path)
+            changed = [yomi for yomi in entries.keys() | self._user_entries.keys()
+                       if entries.get(yomi) != self._user_entries.get(yomi)]
+            if not changed:
+                return True
+            if any(yomi.startswith('-') for yomi in changed):
+                # Removed entries cannot be restored incrementally.
+                return False
+            LOGGER.debug(f'update_user_dictionary: {changed}')
+            system = _system_base[1]
+            if _user_base[0] != user_key:
+                base = self._dict_base.copy()
+                for yomi in changed:
+                    self._update_entries(base, system, entries, yomi)
+                _user_base = (user_key, base, self._max_len, entries)
+            # The new words in the user dictionary come first except for
+            # the words ranked by the input history.
+            for yomi in changed:
+                self._update_entries(self._dict, system, entries, yomi)
+                for y in (yomi, yomi[:-1]) if yomi.endswith('―') else (yomi,):
+                    if y in self._dict:
+                        self._dict[y] = self._rank(y, self._dict[y])
+            self._dict_base = _user_base[1]
+            self._user_entries = entries
+        finally:
+            _base_lock.release()
+        return True
+
+    def user_dictionary_path(self) -> str:
+        return self._user_path
 
     def remove_entry(self, yomi: str, word: str):
         cand = self._dict.get(yomi)
         if cand and word in cand:
-            cand.remove(word)
-            if not cand:
+            cand = tuple(x for x in cand if x != word)
+            if cand:
+                self._dict[yomi] = cand
+            else:
                 del self._dict[yomi]
 
-    def _load_dict(self, dic: dict[str, list[str]], path: str, mode='r', version_checked=True):
-        reorder_only = not version_checked
+    def _load_dict(self, dic: dict[str, tuple[str, ...]], path: str, version_checked=True):
+        strings = self._strings
         try:
-            with open(path, mode) as f:
-                f.seek(0, 0)   # in case opened in the 'a+' mode
+            with tracing.profiled('dictionary', path), open(path) as f:
                 for line in f:
                     line = line.strip(' \n/')
                     if not line:
@@ -182,19 +350,21 @@ class Dictionary:
                     words = line.split(' ', 1)
                     if len(words) < 2:
                         continue
+                    # Share a single string object among the same words
+                    # loaded from several files.
                     yomi = words[0]
-                    words = words[1].strip(' \n/').split('/')
+                    words = [strings.setdefault(word, word) for word in words[1].strip(' \n/').split('/')]
                     if yomi.startswith('-'):
                         self._remove_entries(dic, yomi[1:], words)
                     else:
-                        self._merge_entry(dic, yomi, words, reorder_only)
+                        self._merge_entry(dic, yomi, words)
                         if yomi.endswith('―'):
-                            self._merge_entry(dic, yomi[:-1], [yomi], reorder_only)
+                            self._merge_entry(dic, yomi[:-1], [yomi])
                 LOGGER.debug(f'Loaded {path}')
         except OSError:
             LOGGER.warning(f'could not load "{path}"')
 
-    def _merge_entry(self, dic: dict[str, list[str]], yomi: str, words: list[str], reorder_only: bool):
+    def _merge_entry(self, dic: dict[str, tuple[str, ...]], yomi: str, words: list[str]):
         if not YOMI.match(yomi):
             LOGGER.warning(f'invalid candidate: "{yomi}" / {words}')
             return
@@ -207,46 +377,31 @@ class Dictionary:
         if not words:
             return
 
-        katakana = ''
-        if yomi[-1] != '―':
-            katakana = yomi.translate(TO_KATAKANA)
-            if katakana not in words:
-                katakana = ''
-
         if yomi not in dic:
-            if not reorder_only:
-                dic[yomi] = words
-            elif katakana:
-                dic[yomi] = [katakana]
-            else:
-                self._dirty = True
-
+            dic[yomi] = tuple(words)
             size = len(yomi)
             if yomi[-1] == '―':
                 size -= 1
             self._max_len = max(size, self._max_len)
 
         else:
-            update = dic[yomi][:]
+            update = list(dic[yomi])
             yougen = []
             for word in reversed(words):
                 if word in update:
                     update.remove(word)
                     update.insert(0, word)
-                elif not reorder_only or word[0] in HIRAGANA or word[0] == '#' or word == katakana:
-                    if word[-1] == '―':
-                        yougen.insert(0, word)
-                    else:
-                        update.insert(0, word)
+                elif word[-1] == '―':
+                    yougen.insert(0, word)
                 else:
-                    self._dirty = True
+                    update.insert(0, word)
             update.extend(yougen)
-            dic[yomi] = update
+            dic[yomi] = tuple(update)
 
-    def _remove_entries(self, dic: dict[str, list[str]], yomi: str, cand: list[str]):
+    def _remove_entries(self, dic: dict[str, tuple[str, ...]], yomi: str, cand: list[str]):
         if yomi not in dic:
             return
-        update = [x for x in dic[yomi] if x not in cand]
+        update = tuple(x for x in dic[yomi] if x not in cand)
         LOGGER.debug(f'_remove_entry: {dic[yomi]}→{update}')
         if update:
             dic[yomi] = update
@@ -256,18 +411,18 @@ class Dictionary:
     def add_katakana(self, word):
         LOGGER.debug(f'add_katakana("{word}")')
         yomi = word.translate(TO_HIRAGANA)
-        words = self._dict.get(yomi, [])
+        words = list(self._dict.get(yomi, ()))
         if word in words:
             words.remove(word)
         words.insert(0, word)
-        self._dict[yomi] = words
-        self._dirty = True
+        self._use(yomi, word)
+        self._dict[yomi] = self._rank(yomi, words)
 
     def reset(self):
         if self._shrunk:
             cand = self._dict.get(self._yomi)
             if cand and self._shrunk in cand:
-                cand.remove(self._shrunk)
+                self._dict[self._yomi] = tuple(x for x in cand if x != self._shrunk)
             self._shrunk = ''
         self._yomi = ''
         self._numeric = ''
@@ -366,14 +521,16 @@ class Dictionary:
                 yomi = word
                 shrunk = ''
                 while yomi not in self._dict:
-                    LOGGER.debug(f'lookup_yougen: {yomi}')
+                    if tracing.enabled:
+                        tracing.record('lookup_yougen', yomi=yomi)
                     shrunk += yomi[0]
                     yomi = yomi[1:]
                 # Check shrunken entries that look like,
                 # にし― / ['に知r']
                 m = RE_PREFIX.search(self._dict[yomi][0])
                 if m and yomi.startswith(m.group()):
-                    LOGGER.debug(f'lookup_yougen: "{shrunk}" {yomi}')
+                    if tracing.enabled:
+                        tracing.record('lookup_yougen', shrunk=shrunk, yomi=yomi)
                     shrunk += m.group()
                     yomi = yomi[m.end():]
                 return i, shrunk, yomi
@@ -386,21 +543,23 @@ class Dictionary:
         yomi = text[start:pos]
         if yomi in self._dict:
             self._yomi = yomi
-            self._cand = self._dict[yomi]
+            self._cand = list(self._dict[yomi])
             self._no = 0
             self._order = []
             self._completed = []
             self._numeric = ''
-            LOGGER.debug(f'lookup_next_taigen: yomi: "{self._yomi}", cand: {self._cand}')
+            if tracing.enabled:
+                tracing.record('lookup_next_taigen', yomi=self._yomi, cand=len(self._cand))
         return True
 
     def lookup_numeric(self, text, start, pos, numeric):
-        LOGGER.debug(f'lookup_numeric("{text}", {start}, {pos}, "{numeric}")')
+        if tracing.enabled:
+            tracing.record('lookup_numeric', start=start, pos=pos, numeric=numeric)
         assert text[start:].startswith(numeric)
         yomi = text[start:pos].replace(numeric, '#')
         if yomi in self._dict:
             if yomi[1:] == self._yomi:
-                cand = self._cand[:]
+                cand = list(self._cand)
             else:
                 self._yomi = yomi[1:]
                 cand = []
@@ -417,7 +576,8 @@ class Dictionary:
 
     def lookup_next_yougen(self, text, start, pos, suffix) -> bool:
         # Return False if no more lookup is necessary.
-        LOGGER.debug(f'lookup_next_yougen("{text}", {start}, {pos}, {suffix})')
+        if tracing.enabled:
+            tracing.record('lookup_next_yougen', start=start, pos=pos, suffix=suffix)
         end = suffix + 1
         if text[start] not in HIRAGANA:
             return False
@@ -432,7 +592,8 @@ class Dictionary:
                     pos_okuri = len(word)
                 okuri = word[pos_okuri:]
                 p = self._match(okuri, text[end:])
-                LOGGER.debug(f'lookup_next_yougen: {word} {text[end:]} => {p}')
+                if tracing.enabled:
+                    tracing.record('lookup_next_yougen: match', word=word, okuri=text[end:], p=p)
                 word = word[:pos_okuri] + text[end:pos]
                 if 0 <= p:
                     assert p in (0, 1)
@@ -450,12 +611,14 @@ class Dictionary:
                 self._no = 0
                 self._order = order[0] + order[1]
                 self._completed = [0] * len(cand[0]) + [1] * len(cand[1])
-                LOGGER.debug(f'lookup_next_yougen: {self._cand}, {self._order}, {self._completed}')
+                if tracing.enabled:
+                    tracing.record('lookup_next_yougen: cand', cand=len(self._cand), completed=self._completed)
                 self._numeric = ''
         return True
 
     def lookup(self, text, pos, anchor=0):
-        LOGGER.debug(f'lookup("{text}", {pos}, {anchor})')
+        if tracing.enabled:
+            tracing.record('lookup', size=len(text), pos=pos, anchor=anchor)
         if anchor + self._max_len < pos:
             anchor = pos - self._max_len
         self.reset()
@@ -494,7 +657,8 @@ class Dictionary:
         return stem_list
 
     def assisted_lookup(self, model, text, pos, anchor=0):
-        LOGGER.debug(f'assisted_lookup("{text}", {pos}, {anchor}) : _shrunk="{self._shrunk}"')
+        if tracing.enabled:
+            tracing.record('assisted_lookup', size=len(text), pos=pos, anchor=anchor, shrunk=self._shrunk)
 
         # Clear self._shrunk
         self.reset()
@@ -547,7 +711,9 @@ class Dictionary:
                             del self._cand[0]
                             shrunk = ''
                             suggested -= 1
-                        LOGGER.debug(f'assisted_lookup: {self._yomi} /{suggested_word}/ ; /{shrunk}/')
+                        if tracing.enabled:
+                            tracing.record('assisted_lookup: suggested', yomi=self._yomi, word=suggested_word,
+                                           shrunk=shrunk)
                     if not cont:
                         break
             if shrunk:
@@ -555,9 +721,7 @@ class Dictionary:
                 cand = self._dict.get(yomi)
                 assert cand
                 assert shrunk not in cand
-                cand = cand[:]
-                cand.insert(0, shrunk)
-                self._dict[yomi] = cand
+                self._dict[yomi] = (shrunk,) + cand
                 self._shrunk = shrunk
         else:
             cand = []
@@ -575,17 +739,17 @@ class Dictionary:
                         # Remove shrunk created in the previous lookup
                         cand_shrunk = self._dict.get(text[pos_shrunk:suffix + 1])
                         assert shrunk in cand_shrunk
-                        cand_shrunk.remove(shrunk)
+                        self._dict[text[pos_shrunk:suffix + 1]] = tuple(x for x in cand_shrunk if x != shrunk)
                     shrunk = text[i:pos_found] + stem
                     pos_shrunk = i
                     if shrunk not in cand:
                         # Temporarily register shrunk in the working dictionary
-                        cand = cand[:]
-                        cand.insert(0, shrunk)
+                        cand = (shrunk,) + cand
                         self._dict[text[i:suffix + 1]] = cand
                     else:
                         shrunk = ''
-                    LOGGER.debug(f'assisted_lookup: {text[i:suffix + 1]}, {shrunk}')
+                    if tracing.enabled:
+                        tracing.record('assisted_lookup: yougen', yomi=text[i:suffix + 1], shrunk=shrunk)
                 cont = self.lookup_next_yougen(text, i, pos, suffix)
                 if yomi != self._yomi:
                     yomi = self._yomi
@@ -609,7 +773,9 @@ class Dictionary:
                 if not cont:
                     break
             if 0 <= suggested:
-                LOGGER.debug(f'assisted_lookup: {self._yomi} "{shrunk}-{self._cand[suggested]}"')
+                if tracing.enabled:
+                    tracing.record('assisted_lookup: shrunk', yomi=self._yomi, shrunk=shrunk,
+                                   word=self._cand[suggested])
             self._shrunk = shrunk
 
         return self.current(), suggested
@@ -652,10 +818,10 @@ class Dictionary:
         if self._order:
             yomi = yomi[:yomi.find('―') + 1]
             no = self._order[no]
-            cand = self._dict[yomi][:]
+            cand = list(self._dict[yomi])
         elif self._numeric:
             yomi = '#' + yomi
-            cand = self._dict[yomi][:]
+            cand = list(self._dict[yomi])
             if len(cand) <= no:
                 cand.append('#' + self._cand[no])
                 no = len(cand) - 1
@@ -667,22 +833,18 @@ class Dictionary:
         if first == yomi:
             # Ignore pseudo candidates
             return 0
-        if 0 < no:
-            cand.remove(first)
-            cand.insert(0, first)
-            self._dict[yomi] = cand
-            self._dirty = True
+        self._use(yomi, first)
+        cand = self._rank(yomi, cand)
 
         if self._shrunk:
             assert self._shrunk in cand
             if first == self._shrunk:
-                self._dirty = True
                 self._accept(yomi, self._shrunk)
             else:
-                cand.remove(self._shrunk)
+                cand = tuple(x for x in cand if x != self._shrunk)
                 self._reject(yomi, self._shrunk)
-            self._dict[yomi] = cand
             self._shrunk = ''
+        self._dict[yomi] = cand
 
         # Personalize the dictionary if the candidate has been selected by shrinking the reading.
         if shrunk and not self._numeric:
@@ -690,21 +852,17 @@ class Dictionary:
             cand = self._dict.get(yomi)
             if cand:
                 first = shrunk + first
-                cand = cand[:]
-                try:
-                    cand.remove(first)
-                except ValueError:
-                    pass
-                cand.insert(0, first)
-                self._dict[yomi] = cand
-                self._dirty = True
+                if first not in cand:
+                    cand = (first,) + cand
+                self._use(yomi, first)
+                self._dict[yomi] = self._rank(yomi, cand)
                 no = 0
             elif yomi[-1] == '―':
                 cand = self._dict.get(yomi[:-1])
                 if cand:
                     first = shrunk + first
-                    self._dict[yomi] = [first]
-                    self._dirty = True
+                    self._use(yomi, first)
+                    self._dict[yomi] = (first,)
                     no = 0
 
         return no_orig
@@ -722,29 +880,141 @@ class Dictionary:
     def is_pseudo_candidate(self):
         return self._yomi and self._yomi in self._cand
 
-    def _write_orders(self, filename):
+    #
+    # self._history methods
+    #
+    def _load_history(self, path: str):
+        # The history file lists the words in the descending order of their
+        # scores so that only the entries to be retained are read.
+        with tracing.profiled('history', path), open(path, 'a+') as f:
+            f.seek(0, 0)   # in case opened in the 'a+' mode
+            header = f.readline().strip()
+            if header == f'; {DICTIONARY_VERSION}':
+                self._import_orders(f, int(os.fstat(f.fileno()).st_mtime))
+            elif header == f'; {HISTORY_VERSION}':
+                size = 0
+                for line in f:
+                    if self._history_size <= size:
+                        break
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4:
+                        continue
+                    yomi, word, count, last = fields
+                    try:
+                        count = float(count)
+                        last = int(last)
+                    except ValueError:
+                        continue
+                    if not word or word == yomi or not 0 < count:
+                        continue
+                    self._history.setdefault(yomi, {})[word] = (count, last)
+                    size += 1
+            elif header:
+                LOGGER.warning(f'unknown input history version: "{header}"')
+        LOGGER.debug(f'Loaded {path}')
+        self._apply_history(self._history)
+
+    def _apply_history(self, yomis):
+        for yomi in yomis:
+            history = self._history.get(yomi)
+            if not history or not YOMI.match(yomi):
+                continue
+            cand = self._dict.get(yomi, ())
+            # Restore the words missing in the dictionaries only if they are
+            # written in kana.
+            katakana = '' if yomi[-1] == '―' else yomi.translate(TO_KATAKANA)
+            added = [word for word in history
+                     if word not in cand and (word == katakana or cand and (word[0] in HIRAGANA or word[0] == '#'))]
+            if not cand:
+                if not added:
+                    continue
+                self._max_len = max(len(yomi), self._max_len)
+            self._dict[yomi] = self._rank(yomi, cand + tuple(added))
+
+    def merge_history(self, other: Dictionary):
+        # Take over the words used in other while self was being loaded.
+        if other._history_path != self._history_path:
+            return
+        changed = []
+        for yomi, history in other._history.items():
+            merged = self._history.setdefault(yomi, {})
+            for word, (count, last) in history.items():
+                old = merged.get(word)
+                if old is None or (old[1], old[0]) < (last, count):
+                    merged[word] = (count, last)
+                    changed.append(yomi)
+        self._apply_history(dict.fromkeys(changed))
+
+    def _import_orders(self, lines, last: int):
+        # Convert the orders file of v1.0.0, which listed all the candidates
+        # of the reordered readings. Only the first candidate is kept as the
+        # last one used.
+        for line in lines:
+            line = line.strip(' \n/')
+            if not line or line[0] == ';':
+                continue
+            words = line.split(' ', 1)
+            if len(words) < 2:
+                continue
+            yomi = words[0]
+            word = words[1].strip(' \n/').split('/')[0]
+            if word and word != yomi:
+                self._history.setdefault(yomi, {})[word] = (HISTORY_IMPORT_COUNT, last)
+        self._dirty = True
+
+    def _use(self, yomi: str, word: str):
+        now = int(time.time())
+        history = self._history.setdefault(yomi, {})
+        count, last = history.get(word, (0.0, now))
+        count = _history_count(count, last, now) + 1.0
+        history[word] = (count, now)
+        self._dirty = True
+
+    def _rank(self, yomi: str, cand) -> tuple[str, ...]:
+        # Move the words in the input history ahead of the others in the
+        # descending order of their scores.
+        history = self._history.get(yomi)
+        if not history:
+            return tuple(cand)
+        now = int(time.time())
+        used = sorted((word for word in cand
+                       if word in history and HISTORY_MIN_COUNT <= _history_count(*history[word], now)),
+                      key=lambda word: _history_score(*history[word]), reverse=True)
+        if not used:
+            return tuple(cand)
+        ranked = set(used)
+        return tuple(used) + tuple(word for word in cand if word not in ranked)
+
+    def _write_history(self, filename):
+        # Evict the entries with the lowest scores beyond self._history_size.
+        entries = heapq.nlargest(self._history_size,
+                                 ((_history_score(count, last), yomi, word, count, last)
+                                  for yomi, history in self._history.items()
+                                  for word, (count, last) in history.items()))
+        retained = {}
         with open(filename, 'w') as f:
-            f.write(f'; {DICTIONARY_VERSION}\n')
-            for yomi, words in sorted(self._dict.items()):
-                if yomi not in self._dict_base or words != self._dict_base[yomi]:
-                    f.write(f'{yomi} /{"/".join(words)}/\n')
+            f.write(f'; {HISTORY_VERSION}\n')
+            for _, yomi, word, count, last in entries:
+                f.write(f'{yomi}\t{word}\t{count:.6g}\t{last}\n')
+                retained.setdefault(yomi, {})[word] = (count, last)
+        self._history = retained
 
     def save_orders(self):
         if not self._dirty:
             return
         try:
-            if not os.path.exists(self._orders_path):
-                self._write_orders(self._orders_path)
+            if not os.path.exists(self._history_path):
+                self._write_history(self._history_path)
             else:
-                bakfile = self._orders_path + '.bak'
-                tmpfile = self._orders_path + '.tmp'
-                self._write_orders(tmpfile)
+                bakfile = self._history_path + '.bak'
+                tmpfile = self._history_path + '.tmp'
+                self._write_history(tmpfile)
                 if os.path.exists(bakfile):
                     os.remove(bakfile)
-                os.rename(self._orders_path, bakfile)
-                os.rename(tmpfile, self._orders_path)
+                os.rename(self._history_path, bakfile)
+                os.rename(tmpfile, self._history_path)
         except OSError:
-            LOGGER.exception(f'could not save the orders in "{self._orders_path}"')
+            LOGGER.exception(f'could not save the input history in "{self._history_path}"')
         self._dirty = False
 
     def use_romazi(self, romazi):
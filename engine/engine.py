@@ -17,6 +17,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
 import json
 import logging
 import os
@@ -28,20 +30,15 @@ import time
 
 import gi
 gi.require_version('IBus', '1.0')
-gi.require_version('Gdk', '3.0')
 gi.require_version('Gio', '2.0')
-gi.require_version('GnomeDesktop', '3.0')
-gi.require_version('Gtk', '3.0')
-gi.require_version('Notify', '0.7')
-from gi.repository import Gdk
+gi.require_version('GLib', '2.0')
 from gi.repository import Gio
-from gi.repository import GnomeDesktop
-from gi.repository import Gtk
+from gi.repository import GLib
 from gi.repository import IBus
-from gi.repository import Notify
 
 import llm
 import package
+import tracing
 from dictionary import Dictionary, HIRAGANA, KATAKANA, RE_PREFIX, TO_HIRAGANA, TO_KATAKANA
 from event import Event, KeyboardController
 from package import _
@@ -115,6 +112,9 @@ IAA = '\uFFF9'  # IAA (INTERLINEAR ANNOTATION ANCHOR)
 IAS = '\uFFFA'  # IAS (INTERLINEAR ANNOTATION SEPARATOR)
 IAT = '\uFFFB'  # IAT (INTERLINEAR ANNOTATION TERMINATOR)
 
+# Matches the annotation characters and the ruby text that follows IAS
+RE_RUBY = re.compile(f'[{IAA}{IAT}]|{IAS}[^{IAA}{IAT}]*')
+
 CANDIDATE_FOREGROUND_COLOR = 0x000000
 CANDIDATE_BACKGROUND_COLOR = 0xd1eaff
 PREFIX_LOCK_COLOR = 0x3399ff
@@ -136,22 +136,239 @@ SURROUNDING_BROKEN = -2
 # between delete_surrounding_text() and commit_text(), between multiple
 # forward_key_event(), and before updating the preedit text.
 # Gmail running on Firefox 91.0.2 is an example of such an application.
+# Rather than blocking the main loop, the requests to the client that follow
+# a delay are queued and sent from a GLib timeout.
 EVENT_DELAY = 0.02
 
+# The delay is learned for each client. After EVENT_DELAY_PROBES round trips
+# of delete_surrounding_text() and commit_text() have been confirmed with
+# EVENT_DELAY, the client is tried without the delay. After as many more
+# round trips, the client is recorded in EVENT_DELAY_FILE as not requiring
+# the delay. Such clients are still checked, and a failed round trip without
+# the delay records EVENT_DELAY, which is not checked any more.
+EVENT_DELAY_PROBES = 8
+EVENT_DELAY_FILE = 'event_delays.json'
+
+# The surrounding text is cached only within these numbers of characters
+# before and after the cursor so that editing it does not get slower with
+# long text. The characters before the cursor exceed what the language model
+# takes as the context.
+SURROUNDING_BEFORE = 1024
+SURROUNDING_AFTER = 256
+
+# The engine keeps a mirror of the client's surrounding text updated by the
+# set-surrounding-text notifications and by its own commits and deletions.
+# The client is asked for the surrounding text again only when the mirror
+# has not been updated by the client for this many microseconds.
+SURROUNDING_VALIDATE_INTERVAL = 2000000
+
+# The interval in milliseconds to retry replacing the dictionary reloaded in
+# the background while a conversion is in progress.
+DICTIONARY_SWAP_INTERVAL = 100
+
+# The delay in milliseconds to apply the changes made in the user dictionary
+# file so that a series of file change events is processed at once.
+USER_DICTIONARY_DELAY = 300
+
+# The keyboard layout and the KeyboardController compiled from it are shared
+# by the engines in the process: (key, layout, controller)
+_layout_cache = (None, None, None)
+_layout_lock = threading.Lock()
+
+
+def _get_file_key(paths):
+    key = []
+    for path in paths:
+        try:
+            key.append((path, os.stat(path).st_mtime_ns))
+        except (OSError, TypeError):
+            key.append((path, -1))
+    return tuple(key)
+
+
+def _get_dictionary_args(settings, clear_history=False):
+    permissible = settings.get_boolean('permissible')
+    system = settings.get_string('dictionary')
+    slash = system.rfind('/')
+    if 0 <= slash:
+        # for v0.15.0 or earlier
+        system = system[slash + 1:]
+        if system == 'restrained.dic':
+            system = 'restrained.8.dic'
+    user = settings.get_string('user-dictionary')
+    history_size = settings.get_uint('history-size')
+    return system, user, clear_history, permissible, history_size
+
+
+def _get_layout_paths(settings):
+    input_sources = Gio.Settings.new('org.gnome.desktop.input-sources')
+    mru_sources = input_sources.get_value('mru-sources')
+    xkb_layout = 'us'
+    for i in range(mru_sources.n_children()):
+        v = mru_sources.get_child_value(i)
+        assert v.n_children() == 2
+        source_type = v.get_child_value(0).get_string()
+        source_name = v.get_child_value(1).get_string()
+        if source_type == 'xkb':
+            xkb_layout = source_name
+            break
+    LOGGER.info(f'xkb layout: {xkb_layout}')
+    if xkb_layout in ('us', 'jp'):
+        default_layout = os.path.join(package.get_datadir(), 'layouts', 'roomazi.' + xkb_layout + '.json')
+    else:
+        default_layout = os.path.join(package.get_datadir(), 'layouts', 'roomazi.' + 'us' + '.json')
+    path = package.load_from_data_dirs(
+        os.path.join('layouts', settings.get_string('layout') + '.' + xkb_layout + '.json'))
+    LOGGER.info(f'keyboard layout: "{path}"')
+    altgr_path = package.load_from_data_dirs(
+        os.path.join('layouts', settings.get_string('altgr') + '.' + xkb_layout + '.json'))
+    return path, default_layout, altgr_path
+
+
+def _load_json(pathname):
+    LOGGER.debug(f'_load_json("{pathname}")')
+    layout = {}
+    try:
+        with open(pathname) as f:
+            layout = json.load(f)
+    except OSError:
+        LOGGER.exception(f'could not load "{pathname}"')
+    return layout
+
+
+def _get_layout(paths) -> (dict, KeyboardController):
+    global _layout_cache
+
+    with _layout_lock:
+        key = _get_file_key(paths)
+        if _layout_cache[0] != key:
+            path, default_layout, altgr_path = paths
+            with tracing.profiled('layout', str(path)):
+                layout = _load_json(path)
+                if not layout:
+                    layout = _load_json(default_layout)
+                altgr = _load_json(altgr_path)
+                if altgr:
+                    layout.update(altgr)
+                _layout_cache = (key, layout, KeyboardController(layout))
+        return _layout_cache[1:]
+
+
+# The delays learned for each client are shared by the engines in the process.
+_event_delays = None
+
+
+def _load_event_delays():
+    path = os.path.join(package.get_user_datadir(), EVENT_DELAY_FILE)
+    delays = {}
+    try:
+        with open(path) as f:
+            delays = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        LOGGER.exception(f'could not load "{path}"')
+    if not isinstance(delays, dict):
+        return {}
+    return {client: delay for client, delay in delays.items()
+            if isinstance(delay, (int, float)) and 0 <= delay <= EVENT_DELAY}
+
+
+def _get_event_delays():
+    global _event_delays
+    if _event_delays is None:
+        _event_delays = _load_event_delays()
+    return _event_delays
+
+
+def _save_event_delay(client, delay):
+    # Merge the delay of client into the saved ones so that the delays
+    # learned for the other clients are kept.
+    delays = _get_event_delays()
+    delays.update(_load_event_delays())
+    delays[client] = delay
+    path = os.path.join(package.get_user_datadir(), EVENT_DELAY_FILE)
+    tmpfile = path + '.tmp'
+    try:
+        with open(tmpfile, 'w') as f:
+            json.dump(delays, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmpfile, path)
+    except OSError:
+        LOGGER.exception(f'could not save "{path}"')
+
+
+# Load the base dictionaries, the keyboard layout and the language model
+# shared by the engines in the background so that the first engine created by
+# IBus does not have to load them. An engine created while they are being
+# loaded waits for them on the locks of the caches instead of loading them
+# twice.
+def prewarm():
+    settings = Gio.Settings.new('org.freedesktop.ibus.engine.hiragana')
+    system, user, _, permissible, _ = _get_dictionary_args(settings)
+    layout_paths = _get_layout_paths(settings)
+    use_llm = settings.get_boolean('use-llm')
+    device_type = 'cuda' if settings.get_boolean('use-cuda') else 'cpu'
+
+    def prewarm_thread():
+        start = time.perf_counter()
+        try:
+            Dictionary.load_base(system, user, permissible)
+            _get_layout(layout_paths)
+            llm.load(use_llm, device_type)
+        except Exception:
+            LOGGER.exception('prewarm')
+        LOGGER.info(f'ready in {time.perf_counter() - start:.3f} seconds')
+
+    threading.Thread(target=prewarm_thread, daemon=True).start()
+
+
+# Gdk, GnomeDesktop, Gtk and Notify are imported when they are used first so
+# that the engine process starts only with GLib, Gio and IBus.
+_platform = None    # (platform_version, is_wayland)
+_notify = None
+
+
+def get_platform() -> (int, bool):
+    global _platform
+    if _platform is None:
+        gi.require_version('Gdk', '3.0')
+        gi.require_version('GnomeDesktop', '3.0')
+        from gi.repository import Gdk
+        from gi.repository import GnomeDesktop
+        platform_version = 42
+        if hasattr(GnomeDesktop, 'get_platform_version'):
+            platform_version = GnomeDesktop.get_platform_version()
+        display = Gdk.Display.get_default()
+        is_wayland = 'Wayland' in type(display).__name__
+        LOGGER.info(f'platform_version: {platform_version} / {"Wayland" if is_wayland else "X11"}')
+        _platform = (platform_version, is_wayland)
+    return _platform
+
+
+def get_keymap():
+    gi.require_version('Gdk', '3.0')
+    from gi.repository import Gdk
+    # Note Gdk.Keymap does *not* work as expected in Wayland.
+    return Gdk.Keymap.get_for_display(Gdk.Display.get_default())
+
+
+def get_notify():
+    global _notify
+    if _notify is None:
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify
+        Notify.init('Hiragana IME')
+        _notify = Notify
+    return _notify
+
+
+def uninit_notify():
+    if _notify is not None:
+        _notify.uninit()
+
 
 def get_plain_text(text):
-    plain = ''
-    in_ruby = False
-    for c in text:
-        if c == IAA:
-            in_ruby = False
-        elif c == IAS:
-            in_ruby = True
-        elif c == IAT:
-            in_ruby = False
-        elif not in_ruby:
-            plain += c
-    return plain
+    return RE_RUBY.sub('', text)
 
 
 def to_hankaku(kana):
@@ -217,14 +434,7 @@ class EngineModeless(IBus.Engine):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        self._platform_version = 42
-        if hasattr(GnomeDesktop, 'get_platform_version'):
-            self._platform_version = GnomeDesktop.get_platform_version()
-
-        display = Gdk.Display.get_default()
-        self._is_wayland = 'Wayland' in type(display).__name__
-
-        LOGGER.info(f'platform_version: {self._platform_version} / {"Wayland" if self._is_wayland else "X11"}')
+        self._platform_version, self._is_wayland = get_platform()
 
         self._surrounding = SURROUNDING_RESET
         self._preedit_text = None
@@ -234,13 +444,104 @@ class EngineModeless(IBus.Engine):
         self.roman_text = ''
         self.katakana_text = ''
 
+        # The mirror of the client's surrounding text and cursor position
+        self._mirror = None
+        self._mirror_time = 0
+        self._mirror_edited = False     # edited by the engine since reported by the client
+
+        # The requests to the client and the key events waiting for a delay
+        self._events = collections.deque()
+        self._events_source = 0
+
+        self._client = ''
+        self._event_delay = EVENT_DELAY
+        self._event_delays = _get_event_delays()
+        self._event_probes = {}
+        self._expected_text = ''
+        self._expected_time = 0     # when _expected_text has been sent to the client
+
+    def _set_client(self, client):
+        self._client = client
+        self._expected_text = ''
+        self._expected_time = 0
+        if client in self._event_delays:
+            self._event_delay = self._event_delays[client]
+        elif EVENT_DELAY_PROBES <= self._event_probes.get(client, 0):
+            self._event_delay = 0
+        else:
+            self._event_delay = EVENT_DELAY
+
+    def _check_round_trip(self, text):
+        # Check if the text committed by the last flush() is found before the cursor.
+        expected = self._expected_text
+        if not expected or not self._client or self._event_delays.get(self._client, 0):
+            self._expected_text = ''
+            return
+        if not self._expected_time or self._mirror_edited or self._mirror_time <= self._expected_time:
+            # Wait for the surrounding text reported by the client after the commit.
+            return
+        probes = self._event_probes.get(self._client, 0)
+        if text.endswith(expected):
+            probes += 1
+            if probes == 2 * EVENT_DELAY_PROBES and self._client not in self._event_delays:
+                _save_event_delay(self._client, 0)
+        elif self._event_delay:
+            # The cursor might have been moved.
+            probes = 0
+        else:
+            _save_event_delay(self._client, EVENT_DELAY)
+        LOGGER.debug(f'_check_round_trip("{expected}"): {self._client}: {probes}')
+        self._event_probes[self._client] = probes
+        self._set_client(self._client)
+
     def _forward_backspaces(self, size):
         LOGGER.debug(f'_forward_backspaces({size})')
         for i in range(size):
             self.forward_key_event(IBus.BackSpace, 14, 0)
-            time.sleep(EVENT_DELAY)
+            self.delay_events(self._event_delay)
             self.forward_key_event(IBus.BackSpace, 14, IBus.ModifierType.RELEASE_MASK)
 
+    def _queue_event(self, func, *args):
+        if self.has_pending_events():
+            self._events.append((func, args))
+        else:
+            func(*args)
+
+    def _dispatch_events(self):
+        while self._events and not self._events_source:
+            func, args = self._events.popleft()
+            if func:
+                self._call_event(func, args)
+            else:
+                self._events_source = GLib.timeout_add(round(args[0] * 1000), self._dispatch_events_cb)
+
+    def _dispatch_events_cb(self):
+        self._events_source = 0
+        self._dispatch_events()
+        return GLib.SOURCE_REMOVE
+
+    def _replay_key_event(self, keyval, keycode, state):
+        # Requests made while processing the key event go before the events
+        # queued after it.
+        # Note the key event has already been reported as handled to the
+        # client. A key event not handled here is sent back by
+        # forward_key_event(), which some clients treat differently from the
+        # original event, e.g., for shortcuts and auto-repeat.
+        pending = self._events
+        self._events = collections.deque()
+        try:
+            if not self.do_process_key_event(keyval, keycode, state):
+                self.forward_key_event(keyval, keycode, state)
+        finally:
+            self._events.extend(pending)
+
+    def _call_event(self, func, args):
+        # A failed request must not stop sending the ones that follow it.
+        try:
+            func(*args)
+        except Exception:
+            LOGGER.exception(f'_call_event({func})')
+
     def backspace(self):
         if self.roman_text:
             self.roman_text = self.roman_text[:-1]
@@ -302,7 +603,8 @@ class EngineModeless(IBus.Engine):
         return text
 
     def commit_string(self, text):
-        LOGGER.debug(f'commit_string("{text}"): "{self._preedit_text}"')
+        if tracing.enabled:
+            tracing.record('commit_string', size=len(text), pos=self._preedit_pos)
         if not text:
             return text
         if not self.has_preedit():
@@ -321,12 +623,13 @@ class EngineModeless(IBus.Engine):
             # For FuriganaPad, 'ん' needs to be committed.
             self.commit_text(IBus.Text.new_from_string('ん'))
             # A short delay would be necessary to support Wayland IM module on GNOME 46.
-            time.sleep(EVENT_DELAY)
+            self.delay_events(self._event_delay)
         self._preedit_pos_min += 1
         self._preedit_pos_orig += 1
 
     def delete_surrounding_string(self, size):
-        LOGGER.debug(f'delete_surrounding_string({size})')
+        if tracing.enabled:
+            tracing.record('delete_surrounding_string', size=size, pos=self._preedit_pos)
         assert size <= self._preedit_pos
         self._preedit_text = self._preedit_text[:self._preedit_pos - size] + self._preedit_text[self._preedit_pos:]
         self._preedit_pos -= size
@@ -335,32 +638,40 @@ class EngineModeless(IBus.Engine):
 
     # Note _roman_text is not flushed; use commit_roman() first.
     def flush(self, text='', force=False):
-        LOGGER.debug(f'flush("{text}", {force})')
+        if tracing.enabled:
+            tracing.record('flush', size=len(text), force=force, surrounding=self._surrounding)
         if text:
             self.commit_string(text)
         if self._surrounding == SURROUNDING_COMMITTED:
-            LOGGER.debug(f'flush: SURROUNDING_COMMITTED: "{self._preedit_text}"')
+            if tracing.enabled:
+                tracing.record('flush: committed', size=len(self._preedit_text or ''))
             if self.has_non_empty_preedit():
                 self.commit_text(IBus.Text.new_from_string(self._preedit_text))
             if not force:
                 return self._preedit_text
         elif self.should_draw_preedit():
-            LOGGER.debug(f'flush: should_draw_preedit: "{self._preedit_text}"')
+            if tracing.enabled:
+                tracing.record('flush: draw', size=len(self._preedit_text or ''))
             if self._preedit_text:
                 self.commit_text(IBus.Text.new_from_string(self._preedit_text))
                 self._surrounding = SURROUNDING_RESET
         elif self.has_preedit():
-            LOGGER.debug(f'flush: "{self._preedit_text}" '
-                         f'{self._preedit_pos_min}:{self._preedit_pos_orig}:{self._preedit_pos}')
+            if tracing.enabled:
+                tracing.record('flush: surrounding', min=self._preedit_pos_min, orig=self._preedit_pos_orig,
+                               pos=self._preedit_pos)
             delete_size = self._preedit_pos_orig - self._preedit_pos_min
             if 0 < delete_size:
-                LOGGER.debug(f'flush: delete: {delete_size}')
+                if tracing.enabled:
+                    tracing.record('flush: delete', size=delete_size)
                 self.delete_surrounding_text(-delete_size, delete_size)
             if self._preedit_pos_min < self._preedit_pos:
                 text = self._preedit_text[self._preedit_pos_min:self._preedit_pos]
-                LOGGER.debug(f'flush: insert: "{text}"')
+                if tracing.enabled:
+                    tracing.record('flush: insert', size=len(text))
                 if 0 < delete_size:
-                    time.sleep(EVENT_DELAY)
+                    self.delay_events(self._event_delay)
+                    self._expected_text = text
+                    self._expected_time = 0
                 self.commit_text(IBus.Text.new_from_string(text))
 
         text = self._preedit_text
@@ -370,6 +681,33 @@ class EngineModeless(IBus.Engine):
         self._preedit_pos_orig = 0
         return text
 
+    def delay_events(self, delay):
+        # Delay the following requests to the client by delay seconds.
+        if delay <= 0:
+            return
+        if self.has_pending_events():
+            self._events.append((None, (delay,)))
+        else:
+            self._events_source = GLib.timeout_add(round(delay * 1000), self._dispatch_events_cb)
+
+    def flush_events(self):
+        # Send the pending requests at once, e.g., before the focus moves.
+        while self.has_pending_events():
+            if self._events_source:
+                GLib.source_remove(self._events_source)
+                self._events_source = 0
+            if self._events:
+                func, args = self._events.popleft()
+                if func:
+                    self._call_event(func, args)
+
+    def has_pending_events(self):
+        return bool(self._events_source or self._events)
+
+    def queue_key_event(self, keyval, keycode, state):
+        # Process the key event after the pending requests have been sent.
+        self._events.append((self._replay_key_event, (keyval, keycode, state)))
+
     def get_platform_version(self):
         return self._platform_version
 
@@ -390,9 +728,7 @@ class EngineModeless(IBus.Engine):
             return self._preedit_text, self._preedit_pos
 
         # Cache the current surrounding text in _preedit_text and _preedit_pos
-        surrounding_text = super().get_surrounding_text()
-        text: str = surrounding_text[0].get_text()
-        pos = surrounding_text[1]
+        text, pos = self._get_mirror()
 
         # Qt reports pos as if text is in UTF-16 while GTK reports pos in sane manner.
         # If you're using primarily Qt, use the following code to amend the issue
@@ -405,6 +741,17 @@ class EngineModeless(IBus.Engine):
         #     if 0x10000 <= ord(text[i]):
         #         pos -= 1
 
+        start = pos - SURROUNDING_BEFORE
+        if 0 < start:
+            # Do not start in the middle of a ruby annotation.
+            end = text.find(IAT, start, pos)
+            if 0 <= end and text.find(IAA, start, end) < 0:
+                start = end + 1
+            text = text[start:pos + SURROUNDING_AFTER]
+            pos -= start
+        else:
+            text = text[:pos + SURROUNDING_AFTER]
+
         # Several applications, including Kate and LibreOffice, merge the preedit text to
         # the surrounding text. However, GTK IBus expects that preedit texts are excluded
         # from the surrounding text.
@@ -416,6 +763,7 @@ class EngineModeless(IBus.Engine):
             pos -= roman_len
             # Reset the preedit to remove the redundant characters from the surrounding text.
             self.update_preedit_text(IBus.Text.new_from_string(''), 0, False)
+        self._check_round_trip(text[:pos])
         katakana_len = len(self.katakana_text)
         if 0 < katakana_len:
             if text[:pos].endswith(self.katakana_text):
@@ -427,7 +775,7 @@ class EngineModeless(IBus.Engine):
             text = text[:pos] + self.katakana_text + text[pos:]
             pos += len(self.katakana_text)
             # A short delay is necessary with some input elements in Firefox 130.
-            time.sleep(EVENT_DELAY)
+            self.delay_events(self._event_delay)
         preedit_len = len(preedit)
         if 0 < preedit_len and text[:pos].endswith(preedit):
             text = text[:pos - preedit_len] + text[pos:]
@@ -437,7 +785,8 @@ class EngineModeless(IBus.Engine):
         self._preedit_pos = pos
         self._preedit_pos_min = pos
         self._preedit_pos_orig = pos
-        LOGGER.debug(f'get_surrounding_string: "{self._preedit_text}", {self._preedit_pos}')
+        if tracing.enabled:
+            tracing.record('get_surrounding_string', size=len(self._preedit_text), pos=self._preedit_pos)
         return self._preedit_text, self._preedit_pos
 
     def has_preedit(self):
@@ -449,9 +798,61 @@ class EngineModeless(IBus.Engine):
     def is_wayland(self):
         return self._is_wayland
 
+    def _get_mirror(self):
+        now = GLib.get_monotonic_time()
+        if self._mirror is None or SURROUNDING_VALIDATE_INTERVAL < now - self._mirror_time:
+            surrounding_text = super().get_surrounding_text()
+            self._mirror = (surrounding_text[0].get_text(), surrounding_text[1])
+            self._mirror_time = now
+            self._mirror_edited = False
+        return self._mirror
+
+    def _send_commit_text(self, text):
+        if self._mirror is not None:
+            mirror, pos = self._mirror
+            committed = text.get_text()
+            self._mirror = (mirror[:pos] + committed + mirror[pos:], pos + len(committed))
+            self._mirror_edited = True
+        if self._expected_text and not self._expected_time and text.get_text() == self._expected_text:
+            self._expected_time = GLib.get_monotonic_time()
+        IBus.Engine.commit_text(self, text)
+
+    def _send_delete_surrounding_text(self, offset, nchars):
+        if self._mirror is not None:
+            mirror, pos = self._mirror
+            start = max(0, pos + offset)
+            end = start + nchars
+            pos -= max(0, min(pos, end) - start)
+            self._mirror = (mirror[:start] + mirror[end:], pos)
+            self._mirror_edited = True
+        IBus.Engine.delete_surrounding_text(self, offset, nchars)
+
+    def _send_forward_key_event(self, keyval, keycode, state):
+        # The effect of the key event on the client's text is unknown.
+        self._mirror = None
+        IBus.Engine.forward_key_event(self, keyval, keycode, state)
+
     def should_draw_preedit(self):
         return self._surrounding in (SURROUNDING_NOT_SUPPORTED, SURROUNDING_BROKEN)
 
+    #
+    # methods of IBus.Engine to be sent in order with the delayed requests
+    #
+    def commit_text(self, text: IBus.Text) -> None:
+        self._queue_event(self._send_commit_text, text)
+
+    def delete_surrounding_text(self, offset: int, nchars: int) -> None:
+        self._queue_event(self._send_delete_surrounding_text, offset, nchars)
+
+    def forward_key_event(self, keyval: int, keycode: int, state: int) -> None:
+        self._queue_event(self._send_forward_key_event, keyval, keycode, state)
+
+    def update_preedit_text(self, text: IBus.Text, cursor_pos: int, visible: bool) -> None:
+        self._queue_event(IBus.Engine.update_preedit_text, self, text, cursor_pos, visible)
+
+    def update_lookup_table(self, table: IBus.LookupTable, visible: bool) -> None:
+        self._queue_event(IBus.Engine.update_lookup_table, self, table, visible)
+
     #
     # virtual methods of IBus.Engine
     #
@@ -461,6 +862,8 @@ class EngineModeless(IBus.Engine):
         super().get_surrounding_text()
 
     def do_focus_in_id(self, object_path: str, client: str) -> None:
+        self._set_client(client)
+        self._mirror = None
         # Request the initial surrounding-text in addition to the "enable" handler.
         if not self.has_preedit():
             self.clear()
@@ -469,8 +872,9 @@ class EngineModeless(IBus.Engine):
     def do_set_surrounding_text(self, text: IBus.Text, cursor_pos: int, anchor_pos: int) -> None:
         original = text.get_text()
         original_len = len(original)
-        LOGGER.debug(f'do_set_surrounding_text("{get_plain_text(original)}", {cursor_pos}, {anchor_pos})'
-                     f': {self._surrounding} "{self._preedit_text}"')
+        if tracing.enabled:
+            tracing.record('do_set_surrounding_text', size=original_len, cursor_pos=cursor_pos, anchor_pos=anchor_pos,
+                           surrounding=self._surrounding)
         if self._surrounding == SURROUNDING_BROKEN:
             # flush() will reset the self._surrounding value.
             pass
@@ -487,6 +891,9 @@ class EngineModeless(IBus.Engine):
         else:
             self._surrounding = SURROUNDING_SUPPORTED
             self._preedit_text = None
+        self._mirror = (original, cursor_pos)
+        self._mirror_time = GLib.get_monotonic_time()
+        self._mirror_edited = False
         IBus.Engine.do_set_surrounding_text(self, text, cursor_pos, anchor_pos)
 
 
@@ -515,22 +922,41 @@ class EngineHiragana(EngineModeless):
         self._completed = ''
         self._lookup_table = IBus.LookupTable.new(10, 0, True, False)
         self._lookup_table.set_orientation(IBus.Orientation.VERTICAL)
+        label = IBus.Text.new_from_string(' ')
+        for i in range(self._lookup_table.get_page_size()):
+            self._lookup_table.set_label(i, label)
+        # The lookup table is filled one page at a time with the IBus.Text
+        # objects cached for the current reading.
+        self._candidate_texts = ('', {})
         self._selected = False  # True if a candidate is selected by the user
         self._cursor_pos = -1
 
+        # The preedit text and the lookup table are sent from an idle callback
+        # only when they differ from what was sent last.
+        self._locked = ''
+        self._lookup_serial = 0
+        self._rendered_preedit = None
+        self._rendered_lookup_table = None
+        self._render_source = 0
+
         self._init_props()
 
         self._settings = Gio.Settings.new('org.freedesktop.ibus.engine.hiragana')
         self._settings_handler = 0
 
-        # Note Gdk.Keymap does *not* work as expected in Wayland.
-        self._keymap = Gdk.Keymap.get_for_display(Gdk.Display.get_default())
+        self._keymap = None     # obtained when the engine is enabled first
         self._keymap_handler = 0
 
+        self._user_monitor = None
+        self._user_monitor_handler = 0
+        self._user_monitor_path = ''
+        self._user_dictionary_source = 0
+
         self._logging_level = self._load_logging_level()
 
         self._dict = self._load_dictionary()
-        self._controller = KeyboardController(self._load_layout())
+        self._dict_serial = 0
+        self._controller = self._load_layout()
 
         self.set_mode(self._load_input_mode())
         self._set_x4063_mode(self._load_x4063_mode())
@@ -560,6 +986,7 @@ class EngineHiragana(EngineModeless):
         if 0 < self._keymap_handler:
             self._keymap.disconnect(self._keymap_handler)
             self._keymap_handler = 0
+        self._unwatch_user_dictionary()
 
     def _confirm_candidate(self):
         current = self._dict.current()
@@ -606,7 +1033,14 @@ class EngineHiragana(EngineModeless):
             yomi = 'ん'
             preedit = preedit[1:]
         preedit += c
-        kana = self._controller.transliterate_back(preedit)
+        kana, is_prefix = self._controller.transliterate(preedit)
+        if (not kana and not is_prefix and 2 <= len(preedit)
+                and not (preedit[0] == preedit[1] and preedit[1] in SOKUON)):
+            # No sequence starts with preedit. Leave the preceding letters as
+            # they are and start over with c.
+            yomi += preedit[:-1]
+            preedit = c
+            kana, is_prefix = self._controller.transliterate(preedit)
         if kana:
             yomi += kana + post
             if yomi == 'ー':
@@ -658,20 +1092,86 @@ class EngineHiragana(EngineModeless):
         LOGGER.debug(f'combining-macron: {mode}')
         return mode
 
+    def _get_dictionary_args(self, clear_history=False):
+        return _get_dictionary_args(self._settings, clear_history)
+
     def _load_dictionary(self, clear_history=False):
-        permissible = self._settings.get_boolean('permissible')
-        system = self._settings.get_string('dictionary')
-        slash = system.rfind('/')
-        if 0 <= slash:
-            # for v0.15.0 or earlier
-            system = system[slash + 1:]
-            if system == 'restrained.dic':
-                system = 'restrained.8.dic'
-        user = self._settings.get_string('user-dictionary')
-        dict = Dictionary(system, user, clear_history, permissible)
+        dict = Dictionary(*self._get_dictionary_args(clear_history))
         dict.use_romazi(self._to_kana != self._handle_kana_layout)
         return dict
 
+    def _reload_dictionary(self):
+        # Build the new dictionary in the background so that the user can keep
+        # typing with the current one. Save the input history first so that the
+        # new dictionary can pick it up.
+        self._dict.save_orders()
+        self._dict_serial += 1
+        t = threading.Thread(target=self._reload_dictionary_thread,
+                             args=(self._dict_serial, self._get_dictionary_args()),
+                             daemon=True)
+        t.start()
+
+    def _reload_dictionary_thread(self, serial, args):
+        dict = Dictionary(*args)
+        GLib.idle_add(self._swap_dictionary, serial, dict)
+
+    def _swap_dictionary(self, serial, dict):
+        if serial != self._dict_serial:
+            # A newer dictionary is being loaded.
+            return GLib.SOURCE_REMOVE
+        if self._dict.current():
+            # Wait for the current conversion to complete.
+            GLib.timeout_add(DICTIONARY_SWAP_INTERVAL, self._swap_dictionary, serial, dict)
+            return GLib.SOURCE_REMOVE
+        LOGGER.debug('_swap_dictionary')
+        dict.use_romazi(self._to_kana != self._handle_kana_layout)
+        # Keep the conversions confirmed while the new dictionary was being loaded.
+        self._dict.save_orders()
+        dict.merge_history(self._dict)
+        self._dict = dict
+        self._watch_user_dictionary()
+        return GLib.SOURCE_REMOVE
+
+    def _watch_user_dictionary(self):
+        path = self._dict.user_dictionary_path()
+        if self._user_monitor and self._user_monitor_path == path:
+            return
+        self._unwatch_user_dictionary()
+        if not path:
+            return
+        try:
+            self._user_monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+        except GLib.Error:
+            LOGGER.exception(f'could not watch "{path}"')
+            return
+        self._user_monitor_handler = self._user_monitor.connect('changed', self._user_dictionary_changed_cb)
+        self._user_monitor_path = path
+
+    def _unwatch_user_dictionary(self):
+        if 0 < self._user_monitor_handler:
+            self._user_monitor.disconnect(self._user_monitor_handler)
+            self._user_monitor_handler = 0
+        if self._user_monitor:
+            self._user_monitor.cancel()
+            self._user_monitor = None
+        self._user_monitor_path = ''
+        if 0 < self._user_dictionary_source:
+            GLib.source_remove(self._user_dictionary_source)
+            self._user_dictionary_source = 0
+
+    def _update_user_dictionary(self):
+        if self._dict.current():
+            # Wait for the current conversion to complete.
+            return GLib.SOURCE_CONTINUE
+        updated = self._dict.update_user_dictionary()
+        if updated is None:
+            # Another engine is loading the base dictionaries.
+            return GLib.SOURCE_CONTINUE
+        self._user_dictionary_source = 0
+        if not updated:
+            self._reload_dictionary()
+        return GLib.SOURCE_REMOVE
+
     def _load_input_mode(self):
         mode = self._settings.get_string('mode')
         if mode not in INPUT_MODE_NAMES:
@@ -680,44 +1180,8 @@ class EngineHiragana(EngineModeless):
         LOGGER.debug(f'input mode: {mode}')
         return mode
 
-    def _load_json(self, pathname):
-        LOGGER.debug(f'_load_json("{pathname}")')
-        layout = {}
-        try:
-            with open(pathname) as f:
-                layout = json.load(f)
-        except OSError:
-            LOGGER.exception(f'could not load "{pathname}"')
-        return layout
-
     def _load_layout(self):
-        input_sources = Gio.Settings.new('org.gnome.desktop.input-sources')
-        mru_sources = input_sources.get_value('mru-sources')
-        xkb_layout = 'us'
-        for i in range(mru_sources.n_children()):
-            v = mru_sources.get_child_value(i)
-            assert v.n_children() == 2
-            source_type = v.get_child_value(0).get_string()
-            source_name = v.get_child_value(1).get_string()
-            if source_type == 'xkb':
-                xkb_layout = source_name
-                break
-        LOGGER.info(f'xkb layout: {xkb_layout}')
-        if xkb_layout in ('us', 'jp'):
-            default_layout = os.path.join(package.get_datadir(), 'layouts', 'roomazi.' + xkb_layout + '.json')
-        else:
-            default_layout = os.path.join(package.get_datadir(), 'layouts', 'roomazi.' + 'us' + '.json')
-        path = package.load_from_data_dirs(
-            os.path.join('layouts', self._settings.get_string('layout') + '.' + xkb_layout + '.json'))
-        LOGGER.info(f'keyboard layout: "{path}"')
-        layout = self._load_json(path)
-        if not layout:
-            layout = self._load_json(default_layout)
-        path = package.load_from_data_dirs(
-            os.path.join('layouts', self._settings.get_string('altgr') + '.' + xkb_layout + '.json'))
-        altgr = self._load_json(path)
-        if altgr:
-            layout.update(altgr)
+        layout, controller = _get_layout(_get_layout_paths(self._settings))
         if layout.get('Type') == 'Kana':
             self._to_kana = self._handle_kana_layout
             self._dict.use_romazi(False)
@@ -728,7 +1192,10 @@ class EngineHiragana(EngineModeless):
             self._to_kana = self._handle_default_layout
             self._dict.use_romazi(True)
         self._to_tiny = layout.get('Tiny')
-        return layout
+        # Each engine keeps its own modifier state.
+        controller = copy.copy(controller)
+        controller.reset()
+        return controller
 
     def _load_logging_level(self) -> int:
         level = self._settings.get_string('logging-level')
@@ -738,6 +1205,11 @@ class EngineHiragana(EngineModeless):
         LOGGER.info(f'logging-level: {level}')
         level = NAME_TO_LOGGING_LEVEL[level]
         package.config_logging(level=level, filemode='a')
+        # Trace the hot paths at the INFO level and below. The events traced
+        # are written to the log when the level is raised again.
+        if tracing.enabled and logging.INFO < level:
+            tracing.dump()
+        tracing.enable(__debug__ or level <= logging.INFO)
         return level
 
     def _load_x4063_mode(self):
@@ -770,7 +1242,6 @@ class EngineHiragana(EngineModeless):
         return cand, size
 
     def _assisted_lookup_dictionary(self, text, pos, anchor=0):
-        LOGGER.debug(f'_assisted_lookup_dictionary("{text}", {pos}, {anchor})')
         assert anchor <= pos
         if not self._model:
             return self._lookup_dictionary(text, pos, anchor)
@@ -783,8 +1254,13 @@ class EngineHiragana(EngineModeless):
         anchor = new_anchor
         pos = new_pos
 
+        if tracing.enabled:
+            start = time.perf_counter()
         cand, cursor_pos = self._dict.assisted_lookup(self._model, plain, pos, anchor)
         size = len(self._dict.reading())
+        if tracing.enabled:
+            tracing.record('_assisted_lookup_dictionary', size=len(plain), pos=pos, anchor=anchor,
+                           reading=size, cand=len(self._dict.cand()), duration=time.perf_counter() - start)
         self._selected = False
         self._assisted = cursor_pos
         # Note if the current conversion is complete, it is automatically confirmed.
@@ -793,8 +1269,9 @@ class EngineHiragana(EngineModeless):
                 yomi, assisted = self._dict.get_stem(cursor_pos)
                 if assisted in self._ignored.get(yomi, set()):
                     cursor_pos = 0
-                    LOGGER.debug(f'_assisted_lookup_dictionary: ignore "{assisted}", '
-                                 f'use "{self._dict.cand()[cursor_pos]}"')
+                    if tracing.enabled:
+                        tracing.record('_assisted_lookup_dictionary: ignore', assisted=assisted,
+                                       use=self._dict.cand()[cursor_pos])
                 else:
                     self._dict.set_current(cursor_pos)
             self._cursor_pos = cursor_pos
@@ -807,12 +1284,29 @@ class EngineHiragana(EngineModeless):
         size = len(self._dict.reading())
         assert 0 < size
         self._lookup_table.clear()
+        self._lookup_serial += 1
         assert 0 < size and 1 < len(self._dict.cand()) and not self._dict.is_complete()
-        for i, c in enumerate(self._dict.cand()):
-            self._lookup_table.append_candidate(IBus.Text.new_from_string(c))
-            self._lookup_table.set_label(i, IBus.Text.new_from_string(' '))
+        self._fill_lookup_table(cursor_pos)
         self._lookup_table.set_cursor_pos(cursor_pos)
 
+    def _fill_lookup_table(self, index):
+        # Append the candidates up to the end of the page that includes index.
+        cand = self._dict.cand()
+        page_size = self._lookup_table.get_page_size()
+        end = min(len(cand), (index // page_size + 1) * page_size)
+        start = self._lookup_table.get_number_of_candidates()
+        if end <= start:
+            return
+        reading, texts = self._candidate_texts
+        if reading != self._dict.reading():
+            texts = {}
+            self._candidate_texts = (self._dict.reading(), texts)
+        for c in cand[start:end]:
+            text = texts.get(c)
+            if text is None:
+                text = texts[c] = IBus.Text.new_from_string(c)
+            self._lookup_table.append_candidate(text)
+
     def _process_dakuten(self, c):
         text, pos = self.get_surrounding_string()
         if pos <= 0:
@@ -865,7 +1359,8 @@ class EngineHiragana(EngineModeless):
             self.clear_roman()
             ch = 'ん'
         m = RE_TO_KATAKANA.search(text[:pos] + ch)
-        LOGGER.debug(f'_process_katakana: "{text[:pos] + ch}", {m}')
+        if tracing.enabled:
+            tracing.record('_process_katakana', pos=pos, ch=ch, match=m and m.group())
         if m:
             self.delete_surrounding_string(len(m.group()) - len(ch))
             self.katakana_text = m.group(1).translate(TO_KATAKANA) + m.group(2)
@@ -876,7 +1371,8 @@ class EngineHiragana(EngineModeless):
         suffix = text[pos_yougen:pos].rfind('―')
         assert suffix
         suffix += pos_yougen
-        LOGGER.debug(f'_process_okurigana({pos_yougen}): "{text[:pos]}", {suffix}/{pos}')
+        if tracing.enabled:
+            tracing.record('_process_okurigana', pos_yougen=pos_yougen, suffix=suffix, pos=pos)
         assert pos_yougen < suffix <= pos
         if suffix < pos:
             cand, size = self._assisted_lookup_dictionary(text, pos, pos_yougen)
@@ -1004,7 +1500,8 @@ class EngineHiragana(EngineModeless):
             yomi = self._dict.reading()
             self._confirm_candidate()
             self.commit_string(current.replace('―', ''))
-            LOGGER.debug(f"yomi: '{yomi}', current: '{current}', roman: '{self.roman_text}'")
+            if tracing.enabled:
+                tracing.record('_process_surrounding_text', yomi=yomi, current=current, roman=self.roman_text)
             if current[-1] == '―':
                 # yomi: の, current: の―
                 # yomi: うご, current: うご―
@@ -1185,11 +1682,35 @@ class EngineHiragana(EngineModeless):
             self.update_property(prop)
 
     def _update_lookup_table(self):
-        if self.is_enabled():
-            visible = 0 < self._lookup_table.get_number_of_candidates()
-            self.update_lookup_table(self._lookup_table, visible)
+        if not self._render_source:
+            self._render_source = GLib.idle_add(self._render_cb)
 
     def _update_preedit(self, locked=''):
+        self._locked = locked
+        if not self._render_source:
+            self._render_source = GLib.idle_add(self._render_cb)
+
+    def _render(self):
+        if self._render_source:
+            GLib.source_remove(self._render_source)
+            self._render_source = 0
+        self._render_preedit()
+        self._render_lookup_table()
+
+    def _render_cb(self):
+        self._render_source = 0
+        self._render()
+        return GLib.SOURCE_REMOVE
+
+    def _render_lookup_table(self):
+        visible = self.is_enabled() and 0 < self._lookup_table.get_number_of_candidates()
+        state = (self._lookup_serial, self._lookup_table.get_cursor_pos(), visible)
+        if state != self._rendered_lookup_table:
+            self._rendered_lookup_table = state
+            self.update_lookup_table(self._lookup_table, visible)
+
+    def _render_preedit(self):
+        locked = self._locked
         if self.has_non_empty_preedit() and self.should_draw_preedit():
             preedit_text = self._preedit_text
         else:
@@ -1203,6 +1724,9 @@ class EngineHiragana(EngineModeless):
                     cand = cand[m.end():]
         else:
             cand = self.katakana_text
+        state = (preedit_text, cand, self.roman_text, locked)
+        if state == self._rendered_preedit:
+            return
         text = IBus.Text.new_from_string(preedit_text + cand + self.roman_text + locked)
         preedit_len = len(preedit_text)
         cand_len = len(cand)
@@ -1231,7 +1755,7 @@ class EngineHiragana(EngineModeless):
         # cf. "Qt5 IBus input context does not implement hide_preedit_text()",
         #     https://bugreports.qt.io/browse/QTBUG-48412
         self.update_preedit_text(text, text_len, 0 < text_len)
-        self._update_lookup_table()
+        self._rendered_preedit = state
 
     #
     # setup process methods
@@ -1272,10 +1796,13 @@ class EngineHiragana(EngineModeless):
                 last = line
                 LOGGER.info(f'_setup_sync: {line}')
                 if line == 'reload_dictionaries':
-                    self._dict = self._load_dictionary()
+                    self._reload_dictionary()
                 elif line == 'clear_input_history':
                     package.config_logging(level=self._logging_level, filemode='w')
+                    # Cancel the dictionary being reloaded in the background.
+                    self._dict_serial += 1
                     self._dict = self._load_dictionary(clear_history=True)
+                    self._watch_user_dictionary()
                     self._ignored = {}
                 elif line == 'restart':
                     quit = True
@@ -1293,9 +1820,9 @@ class EngineHiragana(EngineModeless):
 
     def _notify(self):
         icon = os.path.join(package.get_prefix(), 'share/icons/hicolor/scalable/apps/ibus-setup-hiragana.svg')
-        self._notification = Notify.Notification.new(_('Please install LLM packages.'),
-                                                     _('Hiragna IME has updated its python virtual environment.'),
-                                                     icon)
+        self._notification = get_notify().Notification.new(_('Please install LLM packages.'),
+                                                           _('Hiragna IME has updated its python virtual environment.'),
+                                                           icon)
         self._notification.set_app_name(package.get_name())
         self._notification.add_action('reinstall', _('Install...'), self._reinstall)
         self._notification.show()
@@ -1313,10 +1840,10 @@ class EngineHiragana(EngineModeless):
             self._logging_level = self._load_logging_level()
         elif key == 'layout' or key == 'altgr':
             self._reset()
-            self._controller = KeyboardController(self._load_layout())
-        elif key in ('dictionary', 'user-dictionary', 'permissible'):
+            self._controller = self._load_layout()
+        elif key in ('dictionary', 'user-dictionary', 'permissible', 'history-size'):
             self._reset()
-            self._dict = self._load_dictionary()
+            self._reload_dictionary()
         elif key == 'mode':
             mode = self._load_input_mode()
             if mode != self.get_mode():
@@ -1332,6 +1859,15 @@ class EngineHiragana(EngineModeless):
         elif key == 'use-llm':
             self._model = self._load_llm()
 
+    def _user_dictionary_changed_cb(self, monitor, file, other_file, event_type):
+        if event_type not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                              Gio.FileMonitorEvent.CREATED,
+                              Gio.FileMonitorEvent.DELETED):
+            return
+        LOGGER.debug(f'_user_dictionary_changed_cb: {event_type}')
+        if self._user_dictionary_source == 0:
+            self._user_dictionary_source = GLib.timeout_add(USER_DICTIONARY_DELAY, self._update_user_dictionary)
+
     def _keymap_state_changed_cb(self, keymap):
         if self._controller.is_onoff_by_caps():
             lock = keymap.get_caps_lock_state()
@@ -1441,6 +1977,11 @@ class EngineHiragana(EngineModeless):
             if update_list:
                 self._update_input_mode_list()
 
+    def update_preedit_text(self, text: IBus.Text, cursor_pos: int, visible: bool) -> None:
+        # Note EngineModeless also updates the preedit text by itself.
+        self._rendered_preedit = None
+        super().update_preedit_text(text, cursor_pos, visible)
+
     #
     # virtual methods of IBus.Engine
     #
@@ -1455,6 +1996,7 @@ class EngineHiragana(EngineModeless):
             cursor_pos = index
         else:
             cursor_pos = base + index
+        self._fill_lookup_table(cursor_pos)
         self._lookup_table.set_cursor_pos(cursor_pos)
         self._dict.set_current(cursor_pos)
 
@@ -1472,19 +2014,25 @@ class EngineHiragana(EngineModeless):
 
     def do_cursor_down(self) -> bool:
         self._selected = True
+        self._fill_lookup_table(self._lookup_table.get_cursor_pos() + 1)
         if self._lookup_table.cursor_down():
             self._update_candidate()
         return True
 
     def do_cursor_up(self) -> bool:
         self._selected = True
+        if self._lookup_table.get_cursor_pos() == 0:
+            # Fill the table to wrap around to the last candidate.
+            self._fill_lookup_table(len(self._dict.cand()))
         if self._lookup_table.cursor_up():
             self._update_candidate()
         return True
 
     def do_disable(self) -> None:
         LOGGER.debug('do_disable()')
+        self.flush_events()
         self._reset()
+        self._render()
         self._mode = 'A'
         self._dict.save_orders()
         self._disconnect_handlers()
@@ -1492,9 +2040,12 @@ class EngineHiragana(EngineModeless):
     def do_enable(self) -> None:
         super().do_enable()
         self._caps_lock_state = None
+        if self._keymap is None:
+            self._keymap = get_keymap()
         self._keymap_state_changed_cb(self._keymap)
         self._keymap_handler = self._keymap.connect('state-changed', self._keymap_state_changed_cb)
         self._settings_handler = self._settings.connect('changed', self._config_value_changed_cb)
+        self._watch_user_dictionary()
 
     def do_focus_in(self) -> None:
         self.do_focus_in_id('', '')
@@ -1510,6 +2061,8 @@ class EngineHiragana(EngineModeless):
         self._focus_id = object_path
         self._controller.reset()
         self.register_properties(self._prop_list)
+        self._rendered_preedit = None
+        self._rendered_lookup_table = None
         self._update_preedit()
         super().do_focus_in_id(object_path, client)
 
@@ -1518,18 +2071,25 @@ class EngineHiragana(EngineModeless):
 
     def do_focus_out_id(self, object_path: str):
         LOGGER.debug(f'do_focus_out_id("{object_path}"): {self._surrounding}')
+        self.flush_events()
         if self._surrounding != SURROUNDING_BROKEN:
             self._reset()
             self._dict.save_orders()
+        # Send the updates before the focus moves to another client.
+        self._render()
 
     def do_page_down(self) -> bool:
         self._selected = True
+        self._fill_lookup_table(self._lookup_table.get_cursor_pos() + self._lookup_table.get_page_size())
         if self._lookup_table.page_down():
             self._update_candidate()
         return True
 
     def do_page_up(self) -> bool:
         self._selected = True
+        if self._lookup_table.get_cursor_pos() < self._lookup_table.get_page_size():
+            # Fill the table to wrap around to the last page.
+            self._fill_lookup_table(len(self._dict.cand()))
         if self._lookup_table.page_up():
             self._update_candidate()
         return True
@@ -1537,10 +2097,14 @@ class EngineHiragana(EngineModeless):
     # Note IBus.ModifierType.LOCK_MASK bit is always off with the text boxes
     # inside GNOME Shell on X11. This issue is fixed with Wayland.
     def do_process_key_event(self, keyval: int, keycode: int, state: int) -> bool:
-        LOGGER.debug(f'do_process_key_event({keyval:#04x}({IBus.keyval_name(keyval)}), '
-                     f'{keycode}, {state:#010x}({prettify_state(state)}))')
+        if tracing.enabled:
+            tracing.record('do_process_key_event', keyval=IBus.keyval_name(keyval), keycode=keycode,
+                           state=prettify_state(state))
         if keyval == IBus.Super_L or (state & IBus.ModifierType.MOD4_MASK):
             return False
+        if self.has_pending_events():
+            self.queue_key_event(keyval, keycode, state)
+            return True
         if not (state & IBus.ModifierType.RELEASE_MASK):
             self.check_surrounding_support()
         return self._controller.process_key_event(self, keyval, keycode, state)
@@ -1564,6 +2128,8 @@ class EngineHiragana(EngineModeless):
             if self._about_dialog:
                 self._about_dialog.present()
                 return
+            gi.require_version('Gtk', '3.0')
+            from gi.repository import Gtk
             dialog = Gtk.AboutDialog()
             dialog.set_program_name(_('Hiragana IME'))
             dialog.set_copyright('Copyright 2017-2024 Esrille Inc.')
@@ -1597,6 +2163,7 @@ class EngineHiragana(EngineModeless):
 
     def do_reset(self) -> None:
         LOGGER.debug(f'do_reset(): {self._surrounding} "{self._dict.current()}" "{self.katakana_text}"')
+        self.flush_events()
         if self._surrounding != SURROUNDING_BROKEN:
             if self._dict.current() or self.katakana_text:
                 # Firefox 129.0.2 signals an unexpected reset during the conversion.
@@ -1611,5 +2178,6 @@ class EngineHiragana(EngineModeless):
         # always follow the cursor position. The following code is not
         # necessary on Ubuntu 18.04 or Fedora 30.
         LOGGER.debug(f'do_set_cursor_location({x}, {y}, {w}, {h})')
+        self._rendered_lookup_table = None
         self._update_lookup_table()
         EngineModeless.do_set_cursor_location(self, x, y, w, h)
@@ -20,6 +20,8 @@ import gi
 gi.require_version('IBus', '1.0')
 from gi.repository import IBus
 
+import tracing
+
 LOGGER = logging.getLogger(__name__)
 
 MODIFIERS = (IBus.Shift_L, IBus.Shift_R, IBus.Control_L, IBus.Control_R, IBus.Alt_L, IBus.Alt_R)
@@ -49,8 +51,16 @@ NOT_DUAL_CONTROL_R_BIT = CONTROL_R_BIT << 16
 NOT_DUAL_ALT_R_BIT = ALT_R_BIT << 16
 NOT_DUAL_SPACE_BIT = SPACE_BIT << 16
 
+# The classes of keyvals looked up once for each event
+ASCII_CLASS = 0x01
+MODIFIER_CLASS = 0x02
+
+# The size of the keycode tables compiled from the 'Key' and 'AltGr' tables
+KEYCODE_COUNT = 256
+
 
 class Event:
+    __slots__ = ('_controller', 'keyval', 'keycode', 'state', 'modifiers', 'key_class')
 
     def __init__(self, controller: 'KeyboardController', keyval, keycode, state, modifiers):
         self._controller = controller
@@ -58,6 +68,7 @@ class Event:
         self.keycode = keycode
         self.state = state
         self.modifiers = modifiers
+        self.key_class = controller._key_classes.get(keyval, 0)
 
     def has_altgr(self) -> bool:
         return bool(self.modifiers & ALT_R_BIT)
@@ -94,14 +105,10 @@ class Event:
         return self.keyval == IBus.BackSpace
 
     def is_ascii(self) -> bool:
-        # IBus.yen is treated as '¥' for Japanese 109 keyboard.
-        return (IBus.exclam <= self.keyval <= IBus.asciitilde
-                or self.keyval == IBus.yen
-                or self.keyval == IBus.periodcentered
-                or self.is_space())
+        return bool(self.key_class & ASCII_CLASS) or self.is_space()
 
     def is_modifier(self) -> bool:
-        return bool(self.keyval in MODIFIERS)
+        return bool(self.key_class & MODIFIER_CLASS)
 
     def is_prefix(self) -> bool:
         return (self._controller._Prefix
@@ -158,6 +165,22 @@ class KeyboardController:
         self._layout = layout
         self._modifiers = 0
 
+        # The proper prefixes of the Roomazi sequences tell whether a
+        # sequence being typed can still be transliterated.
+        self._roomazi = layout.get('Roomazi', {})
+        self._roomazi_prefixes = frozenset(roman[:i] for roman in self._roomazi for i in range(1, len(roman)))
+
+        # IBus.yen is treated as '¥' for Japanese 109 keyboard.
+        self._key_classes = dict.fromkeys(range(IBus.exclam, IBus.asciitilde + 1), ASCII_CLASS)
+        self._key_classes[IBus.yen] = ASCII_CLASS
+        self._key_classes[IBus.periodcentered] = ASCII_CLASS
+        for keyval in MODIFIERS:
+            self._key_classes[keyval] = MODIFIER_CLASS
+
+        # The characters without and with Shift indexed by keycode
+        self._key_table = self._compile_keys(layout.get('Key', ()))
+        self._altgr_table = self._compile_keys(layout['AltGr']) if 'AltGr' in layout else None
+
         # Set to the default values
         self._OnOffByCaps = True            # or False
         self._SandS = False                 # True if SandS is used
@@ -202,11 +225,26 @@ class KeyboardController:
             if k == IBus.Alt_R:
                 self._capture_alt_r = True
 
+    @staticmethod
+    def _compile_keys(keys):
+        table = [('', '')] * KEYCODE_COUNT
+        if not isinstance(keys, (list, tuple)):
+            LOGGER.warning(f'invalid key table: {keys}')
+            return tuple(table)
+        # Skip the malformed entries so that the other keys can still be used.
+        for keycode, a in enumerate(keys[:KEYCODE_COUNT]):
+            if isinstance(a, (list, tuple)) and 4 <= len(a) and isinstance(a[2], str) and isinstance(a[3], str):
+                table[keycode] = (a[2], a[3])
+            else:
+                LOGGER.warning(f'invalid key entry for keycode {keycode}: {a}')
+        return tuple(table)
+
     def reset(self):
         self._modifiers = 0
 
     def process_key_event(self, engine: IBus.Engine, keyval, keycode, state) -> bool:
-        LOGGER.debug(f'process_key_event: {self._modifiers:#07x}')
+        if tracing.enabled:
+            tracing.record('process_key_event', modifiers=self._modifiers)
 
         # Ignore XFree86 anomaly
         if keyval == IBus.ISO_Left_Tab:
@@ -385,10 +423,10 @@ class KeyboardController:
 
     def get_string(self, e: Event) -> str:
         c = ''
-        if e.has_altgr() and 'AltGr' in self._layout:
-            if e.keycode < len(self._layout['AltGr']):
-                a = self._layout['AltGr'][e.keycode]
-                c = a[3] if e.is_shift() else a[2]
+        if e.has_altgr() and self._altgr_table is not None:
+            if e.keycode < KEYCODE_COUNT:
+                a = self._altgr_table[e.keycode]
+                c = a[1] if e.is_shift() else a[0]
         elif e.is_ascii():
             keyval = IBus.space if e.is_space() else e.keyval
             if keyval == IBus.yen:
@@ -401,13 +439,16 @@ class KeyboardController:
 
     def kana(self, e: Event) -> str:
         c = ''
-        if 'Key' in self._layout and e.keycode < len(self._layout['Key']):
-            a = self._layout['Key'][e.keycode]
-            c = a[3] if e.is_shift() else a[2]
-            LOGGER.debug(f'kana: {c}')
+        if e.keycode < KEYCODE_COUNT:
+            a = self._key_table[e.keycode]
+            c = a[1] if e.is_shift() else a[0]
+            if tracing.enabled:
+                tracing.record('kana', c=c)
         return c
 
+    def transliterate(self, roman: str) -> tuple[str, bool]:
+        # Returns the kana for roman and whether roman can still grow.
+        return self._roomazi.get(roman, ''), roman in self._roomazi_prefixes
+
     def transliterate_back(self, roman: str) -> str:
-        if roman in self._layout['Roomazi']:
-            return self._layout['Roomazi'][roman]
-        return ''
+        return self._roomazi.get(roman, '')
@@ -20,6 +20,7 @@ import gi
 gi.require_version('IBus', '1.0')
 from gi.repository import IBus
 
+import tracing
 from engine import EngineHiragana
 
 LOGGER = logging.getLogger(__name__)
@@ -38,4 +39,8 @@ class EngineFactory(IBus.Factory):
     def do_create_engine(self, engine_name: str) -> EngineHiragana:
         assert engine_name == 'hiragana', 'Invalid engine name'
         self._engine_id += 1
-        return EngineHiragana(self._bus, ENGINE_PATH % self._engine_id, self._app)
+        with tracing.profiled('engine', engine_name):
+            engine = EngineHiragana(self._bus, ENGINE_PATH % self._engine_id, self._app)
+        if self._engine_id == 1:
+            self._app.write_profile()
+        return engine
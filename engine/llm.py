@@ -19,8 +19,10 @@ from __future__ import annotations
 import logging
 import os
 import re
+import threading
 
 import package
+import tracing
 
 LOGGER = logging.getLogger(__name__)
 MODEL_NAME = 'cl-tohoku/bert-base-japanese-v3'
@@ -33,6 +35,7 @@ RE_PREFIX = re.compile(f'[{HIRAGANA}]+')
 RE_SUFFIX = re.compile(f'[{HIRAGANA}]*[1iIkKgsStnbmrwW235]?$')
 
 model = None
+_lock = threading.Lock()  # held while the model is being loaded
 
 
 class LanguageModel:
@@ -100,7 +103,8 @@ class LanguageModel:
 
     def assist_yougen(self, prefix, yomi, stem_list) -> dict[int, float]:
         assert '―' in yomi
-        LOGGER.debug(f"_assist_yougen('{prefix}', '{yomi}', {stem_list})")
+        if tracing.enabled:
+            tracing.record('assist_yougen', size=len(prefix), yomi=yomi, stems=len(stem_list))
         if len(stem_list) == 1:
             return {0: 1.0}
 
@@ -167,7 +171,8 @@ class LanguageModel:
                             assert suffix
                             word = stem[:suffix.start()] + yomi[pos + 1:]
                             if self._match(token, word, stem[suffix.start():]):
-                                LOGGER.debug(f'{token}')
+                                if tracing.enabled:
+                                    tracing.record('assist_yougen: token', token=token)
                                 v.append(vocab[token])
                         if v:
                             yougen_p[j] = sum(probabilities[v].tolist())
@@ -200,7 +205,8 @@ class LanguageModel:
                                 assert suffix
                                 word = stem[:suffix.start()] + yomi[pos + 1:]
                                 if self._match(token, word, stem[suffix.start():]):
-                                    LOGGER.debug(f'{token}')
+                                    if tracing.enabled:
+                                        tracing.record('assist_yougen: token', token=token)
                                     v.append(vocab[token])
                             if v:
                                 yougen_p[k] = sum(probabilities[v].tolist())
@@ -210,16 +216,16 @@ class LanguageModel:
         p_list = []
         for i in range(len(stem_list)):
             p_list.append(prefix_p[shrink_index[i]] * yougen_p[i])
-            LOGGER.debug(f'  {stem_list[i]} {prefix_p[shrink_index[i]]} * {yougen_p[i]} = {p_list[i]}')
-
-        for i, p in enumerate(p_list):
-            LOGGER.debug(f'  {stem_list[i]} {p}')
+            if tracing.enabled:
+                tracing.record('assist_yougen: p', stem=stem_list[i], prefix=prefix_p[shrink_index[i]],
+                               yougen=yougen_p[i], p=p_list[i])
 
         p_dict = {index: value for index, value in enumerate(p_list)}
         return p_dict
 
     def assist(self, prefix, yomi, words) -> dict[int, float]:
-        LOGGER.debug(f"assist('{prefix}', '{yomi}', {words})")
+        if tracing.enabled:
+            tracing.record('assist', size=len(prefix), yomi=yomi, words=len(words))
         yougen_yomi = []
         yougen_list = []
         pos_yougen = -1
@@ -277,8 +283,8 @@ class LanguageModel:
         for i in range(pos_cand, len(words)):
             if encoded_inputs.input_ids[i][mask_token_index] == self._tokenizer.unk_token_id:
                 if yougen_yomi[i - pos_cand] in self._yougen_tokens:
-                    LOGGER.debug(f'assist: {yougen_yomi[i - pos_cand]} '
-                                 f'{self._tokenizer.decode(self._yougen_tokens[yougen_yomi[i - pos_cand]])}')
+                    if tracing.enabled:
+                        tracing.record('assist: yougen', yomi=yougen_yomi[i - pos_cand])
                     p = sum(probabilities[self._yougen_tokens[yougen_yomi[i - pos_cand]]].tolist())
                 else:
                     p = 0.0
@@ -314,8 +320,8 @@ class LanguageModel:
 
                 if pos_cand <= j and ids[i] == self._tokenizer.unk_token_id:
                     if yougen_yomi[j - pos_cand] in self._yougen_tokens:
-                        LOGGER.debug(f'assist: {yougen_yomi[j - pos_cand]} '
-                                     f'{self._tokenizer.decode(self._yougen_tokens[yougen_yomi[j - pos_cand]])}')
+                        if tracing.enabled:
+                            tracing.record('assist: yougen', yomi=yougen_yomi[j - pos_cand])
                         probabilities[j] *= sum(p[self._yougen_tokens[yougen_yomi[j - pos_cand]]].tolist())
                     else:
                         probabilities[j] = 0.0
@@ -327,7 +333,8 @@ class LanguageModel:
                             calculated.add(k)
 
         for i, ids in enumerate(encoded_inputs.input_ids):
-            LOGGER.debug(f'  {self._tokenizer.decode(ids)} ({len(ids)}) {probabilities[i]}')
+            if tracing.enabled:
+                tracing.record('assist: p', ids=len(ids), p=probabilities[i])
 
         if pos_yougen < 0:
             p_dict = {index: value for index, value in enumerate(probabilities)}
@@ -340,19 +347,21 @@ class LanguageModel:
 def load(enable: bool, device_type: str = 'cpu'):
     global model
 
-    if not enable:
+    with _lock:
+        if not enable:
+            model = None
+            return None
+        if model and model.device_type() == device_type:
+            return model
         model = None
-        return None
-    if model and model.device_type() == device_type:
+        try:
+            with tracing.profiled('model', f'{MODEL_NAME} ({device_type})'):
+                model = LanguageModel(device_type)
+        except ImportError:
+            LOGGER.exception('Could not import transformers')
+        except OSError:
+            LOGGER.exception(f'Could not load {MODEL_NAME}')
         return model
-    model = None
-    try:
-        model = LanguageModel(device_type)
-    except ImportError:
-        LOGGER.exception('Could not import transformers')
-    except OSError:
-        LOGGER.exception(f'Could not load {MODEL_NAME}')
-    return model
 
 
 def get_info() -> str:
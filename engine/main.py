@@ -25,15 +25,19 @@ import os
 import signal
 import sys
 
+import tracing
+# Start profiling before importing the other modules to time their imports.
+if '--profile-startup' in sys.argv:
+    tracing.start_profile()
+
 import gi
 gi.require_version('GLib', '2.0')
 gi.require_version('IBus', '1.0')
-gi.require_version('Notify', '0.7')
 from gi.repository import GLib
 from gi.repository import IBus
-from gi.repository import Notify
 
 import package
+from engine import prewarm, uninit_notify
 from factory import EngineFactory
 
 
@@ -85,6 +89,10 @@ class IMApp:
     def run(self):
         self._mainloop.run()
 
+    def write_profile(self):
+        path = os.path.join(package.get_user_datadir(), f'startup-profile-{package.get_version()}.json')
+        tracing.write_profile(path, package.get_version())
+
     def quit(self, status: int = 0):
         LOGGER.debug(f'quit({status})')
         self._status = status
@@ -98,6 +106,8 @@ def print_help(v=0):
     print('-i, --ibus             executed by IBus.')
     print('-h, --help             show this message.')
     print('-d, --daemonize        daemonize ibus')
+    print('-p, --prewarm          load the dictionary, layout and model at startup')
+    print('    --profile-startup  write the time taken by each step of the startup')
     sys.exit(v)
 
 
@@ -152,9 +162,10 @@ def main():
 
     exec_by_ibus = False
     daemonize = False
+    prewarm_engine = False
 
-    shortopt = 'ihd'
-    longopt = ['ibus', 'help', 'daemonize']
+    shortopt = 'ihdp'
+    longopt = ['ibus', 'help', 'daemonize', 'prewarm', 'profile-startup']
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortopt, longopt)
@@ -168,18 +179,24 @@ def main():
             daemonize = True
         elif o in ('-i', '--ibus'):
             exec_by_ibus = True
+        elif o in ('-p', '--prewarm'):
+            prewarm_engine = True
 
     if daemonize:
         if os.fork():
             return 0
 
-    Notify.init('Hiragana IME')
-    IBus.init()
-    app = IMApp(exec_by_ibus)
+    if prewarm_engine:
+        prewarm()
+    with tracing.profiled('init', 'IBus'):
+        IBus.init()
+    with tracing.profiled('init', 'IMApp'):
+        app = IMApp(exec_by_ibus)
     signal.signal(signal.SIGTERM, lambda signum, frame: cleanup(app))
     signal.signal(signal.SIGINT, lambda signum, frame: cleanup(app))
     app.run()
-    Notify.uninit()
+    app.write_profile()
+    uninit_notify()
     return app._status
 
 
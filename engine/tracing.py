@@ -0,0 +1,155 @@
+# ibus-hiragana - Hiragana IME for IBus
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tracing for the hot paths of the engine.
+#
+# Check enabled before building the fields so that the disabled trace costs
+# a single flag check:
+#
+#     if tracing.enabled:
+#         tracing.record('lookup', size=len(text), pos=pos)
+#
+# Record the sizes of the user's text rather than the text itself. The
+# recorded events are kept in a ring buffer, and written to the log by
+# dump(), which replaces the strings with their lengths. They are also
+# logged as they are recorded if the debug level is enabled for the logger.
+#
+# The startup is profiled separately by start_profile(). The time taken by
+# each import, dictionary file, keyboard layout and model is recorded with
+#
+#     with tracing.profiled('dictionary', path):
+#         ...
+#
+# and written by write_profile() as a JSON report that can be compared
+# across versions.
+
+import builtins
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# The number of the most recent events kept in the ring buffer
+TRACE_SIZE = 4096
+
+enabled = False
+
+_events = collections.deque(maxlen=TRACE_SIZE)
+
+
+def enable(on: bool):
+    global enabled
+    enabled = on
+
+
+def record(stage: str, **fields):
+    _events.append((time.monotonic(), stage, fields))
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('%s: %s', stage, fields)
+
+
+def dump():
+    # Write the recorded events to the log, and clear the ring buffer.
+    for timestamp, stage, fields in _events:
+        # Keep what the user typed out of the log.
+        fields = {key: f'<{len(value)}>' if isinstance(value, str) else value for key, value in fields.items()}
+        LOGGER.warning('%.6f %s: %s', timestamp, stage, fields)
+    _events.clear()
+
+
+profiling = False
+
+_profile = []
+_profile_start = 0.0
+_import_depth = threading.local()
+
+
+def start_profile():
+    global profiling, _profile_start
+    if profiling:
+        return
+    profiling = True
+    _profile_start = time.perf_counter()
+    builtins.__import__ = _profile_import(builtins.__import__)
+
+
+def _profile_import(original):
+    def __import__(name, globals=None, locals=None, fromlist=(), level=0):
+        # Time only the imports that load new modules.
+        if level:
+            return original(name, globals, locals, fromlist, level)
+        if name in sys.modules:
+            names = [f'{name}.{x}' for x in fromlist or () if x != '*' and f'{name}.{x}' not in sys.modules]
+            if not names:
+                return original(name, globals, locals, fromlist, level)
+        else:
+            names = [name]
+        depth = getattr(_import_depth, 'value', 0)
+        _import_depth.value = depth + 1
+        start = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            _import_depth.value = depth
+            for name in names:
+                if name in sys.modules:
+                    _record_profile('import', name, start, depth=depth)
+    return __import__
+
+
+def _record_profile(stage: str, name: str, start: float, **fields):
+    end = time.perf_counter()
+    _profile.append(dict(stage=stage, name=name, start=round(start - _profile_start, 6),
+                         duration=round(end - start, 6), thread=threading.current_thread().name, **fields))
+
+
+@contextlib.contextmanager
+def profiled(stage: str, name: str):
+    if not profiling:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_profile(stage, name, start)
+
+
+def write_profile(path: str, version: str):
+    # Write the events recorded since start_profile() as a JSON report.
+    if not profiling:
+        return
+    report = {
+        'version': version,
+        'python': platform.python_version(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'elapsed': round(time.perf_counter() - _profile_start, 6),
+        'events': list(_profile),
+    }
+    try:
+        with open(path, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    except OSError:
+        LOGGER.exception(f'could not write "{path}"')
+        return
+    LOGGER.info(f'startup profile: "{path}" ({report["elapsed"]:.3f} seconds)')
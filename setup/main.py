@@ -16,6 +16,7 @@
 
 import argparse
 import gettext
+import importlib.util
 import locale
 import logging
 import os
@@ -39,6 +40,14 @@ import package
 from package import _
 
 MODEL_NAME = 'cl-tohoku/bert-base-japanese-v3'
+# Files that must be in the local Hugging Face cache to load the model.
+# Each tuple lists alternatives; one of them is enough.
+MODEL_FILES = (
+    ('config.json',),
+    ('model.safetensors', 'pytorch_model.bin'),
+    ('vocab.txt',),
+    ('tokenizer_config.json',),
+)
 USER_DICTIONARY_COMMENT = _("""; Hiragana IME User Dictionary
 ;
 ; Lines starting with a semicolon (;) are comments.
@@ -53,18 +62,21 @@ USER_DICTIONARY_COMMENT = _("""; Hiragana IME User Dictionary
 """)
 
 
-# Note Python caches the module in the directory when the program starts
+# Check if the packages and the model files are installed without loading
+# them; loading the model is left to the engine.
 def check_requirements() -> bool:
-    try:
-        from transformers import AutoModelForMaskedLM, AutoTokenizer
-    except ImportError as e:
-        logging.debug(f'{e}')
-        return False
-    try:
-        AutoModelForMaskedLM.from_pretrained(MODEL_NAME, local_files_only=True)
-        AutoTokenizer.from_pretrained(MODEL_NAME, local_files_only=True)
-    except OSError:
-        return False
+    # Note Python caches the module in the directory when the program starts
+    importlib.invalidate_caches()
+    # fugashi and unidic_lite are required by the tokenizer of the model.
+    for name in ('transformers', 'torch', 'huggingface_hub', 'fugashi', 'unidic_lite'):
+        if importlib.util.find_spec(name) is None:
+            logging.debug(f'{name} is not installed')
+            return False
+    from huggingface_hub import try_to_load_from_cache
+    for files in MODEL_FILES:
+        if not any(isinstance(try_to_load_from_cache(MODEL_NAME, file), str) for file in files):
+            logging.debug(f'{files[0]} is not cached')
+            return False
     return True
 
 
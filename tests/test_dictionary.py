@@ -17,6 +17,9 @@
 # limitations under the License.
 
 import logging
+import os
+import tempfile
+import time
 import unittest
 
 import gi
@@ -40,6 +43,8 @@ class TestDictionary(unittest.TestCase):
         user = settings.get_string('user-dictionary')
         cls.dict = Dictionary(path, user, True)
         cls.model = llm.load(True)
+        cls.path = path
+        cls.user = user
 
     def test__match(self):
         self.dict.use_romazi(False)
@@ -141,6 +146,158 @@ class TestDictionary(unittest.TestCase):
         self.dict.confirm('')
         self.assertEqual(cand, 'か月')
 
+    def test_confirm_keeps_base(self):
+        text = 'きかい'
+        self.dict.lookup(text, len(text))
+        cand = list(self.dict.cand())
+        if len(cand) < 2:
+            self.skipTest(f'Not enough candidates for "{text}"')
+            return
+        base = self.dict._dict_base[text]
+        self.dict.set_current(1)
+        self.dict.confirm('')
+        self.dict.reset()
+        self.assertEqual(self.dict._dict[text][0], cand[1])
+        self.assertIsInstance(self.dict._dict[text], tuple)
+        self.assertEqual(self.dict._dict_base[text], base)
+
+    def test_history_size(self):
+        dict = Dictionary(self.path, self.user, history_size=4)
+        now = int(time.time())
+        dict._history = {'きかい': {'機械': (1.5, now - dictionary.HISTORY_HALF_LIFE),
+                                 '奇怪': (1.0, now - 2 * dictionary.HISTORY_HALF_LIFE)}}
+        dict._use('きかい', '機会')
+        dict._use('きかい', '機会')
+        dict._use('かい', '会')
+        # 奇怪 is not ranked any more.
+        self.assertEqual(dict._rank('きかい', ['奇怪', '機器', '機械', '機会']), ('機会', '機械', '奇怪', '機器'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'history')
+            # Nothing is evicted within the history size.
+            dict._write_history(path)
+            self.assertEqual(set(dict._history['きかい']), {'機会', '機械', '奇怪'})
+            dict._history_size = 2
+            dict._write_history(path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines[0], f'; {dictionary.HISTORY_VERSION}')
+        self.assertEqual([line.split('\t')[:2] for line in lines[1:]], [['きかい', '機会'], ['かい', '会']])
+        self.assertEqual(list(dict._history['きかい']), ['機会'])
+
+    def _load_history(self, content, history_size=dictionary.HISTORY_SIZE):
+        dict = Dictionary(self.path, self.user, history_size=history_size)
+        dict._dict = dict._dict_base.copy()
+        dict._history = {}
+        dict._dirty = False
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'history')
+            with open(path, 'w') as f:
+                f.write(content)
+            dict._load_history(path)
+        return dict
+
+    def test_load_history(self):
+        if 'きかい' not in self.dict._dict_base:
+            self.skipTest('No candidates for "きかい"')
+            return
+        now = int(time.time())
+        dict = self._load_history(f'; {dictionary.HISTORY_VERSION}\n'
+                                  f'きかい\t機会\t2\t{now}\n'
+                                  'きかい 機械 1\n'
+                                  f'きかい\t機器\tx\t{now}\n'
+                                  f'きかい\tぎかい\t1\t{now}\n'
+                                  f'きかい\t鬼怪\t1\t{now}\n'
+                                  f'ぬぺぬぺ\tヌペヌペ\t1\t{now}\n'
+                                  f'ほげほげ\t歩下\t1\t{now}\n'
+                                  f'かい\t会\t1\t{now}\n',
+                                  history_size=5)
+        self.assertEqual(dict._history['きかい'], {'機会': (2.0, now), 'ぎかい': (1.0, now), '鬼怪': (1.0, now)})
+        self.assertNotIn('かい', dict._history)
+        # Only the words written in kana are restored.
+        self.assertEqual(dict._dict['きかい'][:2], ('機会', 'ぎかい'))
+        self.assertNotIn('鬼怪', dict._dict['きかい'])
+        self.assertEqual(dict._dict['ぬぺぬぺ'], ('ヌペヌペ',))
+        self.assertNotIn('ほげほげ', dict._dict)
+        self.assertFalse(dict._dirty)
+
+    def test_import_orders(self):
+        if 'きかい' not in self.dict._dict_base:
+            self.skipTest('No candidates for "きかい"')
+            return
+        dict = self._load_history(f'; {dictionary.DICTIONARY_VERSION}\n'
+                                  'きかい /奇怪/機械/機会/\n'
+                                  '; comment\n'
+                                  'ほげほげ\n')
+        self.assertEqual(list(dict._history), ['きかい'])
+        self.assertEqual(list(dict._history['きかい']), ['奇怪'])
+        self.assertEqual(dict._history['きかい']['奇怪'][0], dictionary.HISTORY_IMPORT_COUNT)
+        self.assertEqual(dict._dict['きかい'][0], '奇怪')
+        self.assertTrue(dict._dirty)
+
+    def test_update_user_dictionary(self):
+        if 'きかい' not in self.dict._dict_base:
+            self.skipTest('No candidates for "きかい"')
+            return
+        base = self.dict._dict_base['きかい']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'user.dic')
+            mtime = [time.time_ns()]
+
+            def write(content):
+                with open(path, 'w') as f:
+                    f.write(content)
+                mtime[0] += 1000000000
+                os.utime(path, ns=(mtime[0], mtime[0]))
+
+            write('ぬぺぬぺ /奴辺/\n')
+            dict = Dictionary(self.path, path)
+            dict._history = {}
+            self.assertEqual(tuple(dict._dict['ぬぺぬぺ']), ('奴辺',))
+
+            # Add words
+            dict._use('きかい', base[1])
+            write('ぬぺぬぺ /奴辺/努辺/\nきかい /木界/\n')
+            self.assertTrue(dict.update_user_dictionary())
+            self.assertEqual(tuple(dict._dict['ぬぺぬぺ']), ('奴辺', '努辺'))
+            self.assertEqual(list(dict._dict['きかい'][:2]), [base[1], '木界'])
+
+            # Remove words
+            write('ぬぺぬぺ /奴辺/\n')
+            self.assertTrue(dict.update_user_dictionary())
+            self.assertEqual(tuple(dict._dict['ぬぺぬぺ']), ('奴辺',))
+            self.assertNotIn('木界', dict._dict['きかい'])
+
+            # Add and remove a reading ending with '―'
+            write('ぬぺぬぺ /奴辺/\nぬぺ― /奴―/\n')
+            self.assertTrue(dict.update_user_dictionary())
+            self.assertEqual(tuple(dict._dict['ぬぺ―']), ('奴―',))
+            self.assertIn('ぬぺ―', dict._dict['ぬぺ'])
+            write('ぬぺぬぺ /奴辺/\n')
+            self.assertTrue(dict.update_user_dictionary())
+            self.assertNotIn('ぬぺ―', dict._dict)
+            self.assertNotIn('ぬぺ', dict._dict)
+
+            # Removed entries require reloading the dictionary.
+            write('ぬぺぬぺ /奴辺/\n-きかい /機械/\n')
+            self.assertFalse(dict.update_user_dictionary())
+
+    def test_merge_history(self):
+        if 'きかい' not in self.dict._dict_base:
+            self.skipTest('No candidates for "きかい"')
+            return
+        base = self.dict._dict_base['きかい']
+        old = Dictionary(self.path, self.user)
+        new = Dictionary(self.path, self.user)
+        old._use('きかい', base[2])
+        new.merge_history(old)
+        self.assertEqual(new._history['きかい'][base[2]], old._history['きかい'][base[2]])
+        self.assertEqual(new._dict['きかい'][0], base[2])
+
+    def test_shared_base(self):
+        dict = Dictionary(self.path, self.user)
+        self.assertIs(dict._dict_base, self.dict._dict_base)
+        self.assertIsNot(dict._dict, self.dict._dict)
+
     def test_conj_max(self):
         for katuyou in dictionary.KATUYOU.values():
             result = len(max(katuyou, key=self.dict.opt_len))